@@ -1,3 +1,4 @@
+import argparse
 from math import ceil
 from pathlib import Path
 from typing import Tuple
@@ -6,6 +7,12 @@ import cv2
 from PIL import Image
 import numpy as np
 
+from packageland import handler
+
+Image.MAX_IMAGE_PIXELS = None
+# cv2.remap asserts every side of its source and destination is under SHRT_MAX
+REMAP_MAX = 32766
+
 
 def get_h_w_c(image: np.ndarray) -> Tuple[int, int, int]:
     """Returns the height, width, and number of channels."""
@@ -73,34 +80,192 @@ def AverageColorFix(input_img, ref_img, scale_factor: float):
         return np.clip(result, 0, 1)
 
 
-references_path = Path('./reference')
-inputs_path = Path('./input')
-reference_list = list(references_path.glob('**/*.*'))
-input_list = list(inputs_path.glob('**/*.*'))
-if len(reference_list) == len(input_list):
-    # extremely bare-bones verification of content, ideally would check each item to have same sub-path and name.
-    for reference_path, input_path in zip(reference_list, input_list):
-        if reference_path.stem == input_path.stem:
-            print("ref: " + reference_path.name)
-            print("in:  " + input_path.name)
-            input_image = Image.open(input_path)
-            reference_image = Image.open(reference_path)
-            if input_image.mode == "L":
-                input_array = np.asarray(input_image.convert('RGB')) / 255
-            else:
-                input_array = np.asarray(input_image) / 255
-            if reference_image.mode == "L":
-                reference_array = np.asarray(reference_image.convert('RGB')) / 255
-            else:
-                reference_array = np.asarray(reference_image) / 255
-            output_array = AverageColorFix(input_array, reference_array, 25)
-            output_image = Image.fromarray((output_array * 255).astype(np.uint8))
-            output_path = Path.joinpath(
-                Path('./output'), (input_path.relative_to(*inputs_path.parts[:1]).with_name(input_path.stem + '.png')))
-            output_path.parent.mkdir(exist_ok=True, parents=True)
-            output_image.save(output_path)
+def downscale_area(input_img, size, channels):
+    """
+    INTER_AREA downscale of the first `channels` channels of a uint8 image to float32 in 0 to 1. when the height
+    shrinks by a whole number, it's done in row strips that line up with output rows, which gives the same result as
+    converting the whole image first, and only each strip's channels are copied. otherwise cv2 downscales the whole
+    uint8 image, extra channels and all since INTER_AREA treats channels separately, rather than copying the input
+    without them, and the result is off by up to half a level.
+    """
+    input_h = input_img.shape[0]
+    ref_w, ref_h = size
+    if input_h % ref_h:
+        return cv2.resize(input_img, size, interpolation=cv2.INTER_AREA)[:, :, :channels].astype(np.float32) / 255
+    factor = input_h // ref_h
+    out_rows = max(1, 256 // factor)
+    out = np.empty((ref_h, ref_w, channels), np.float32)
+    for y in range(0, ref_h, out_rows):
+        strip = input_img[y * factor:(y + out_rows) * factor, :, :channels].astype(np.float32) / 255
+        out[y:y + out_rows] = cv2.resize(strip, (ref_w, len(strip) // factor), interpolation=cv2.INTER_AREA)
+    return out
+
+
+def AverageColorFixTiled(input_img, ref_img, scale_factor: float, bit_depth=8, tile_rows=1024):
+    """
+    AverageColorFix for images too big for it. input_img stays uint8, the diff is only computed at the reference's
+    size, and the cubic upsample of it is added in tiles of `tile_rows` rows by at most REMAP_MAX columns straight into
+    the output buffer. the upsample of each tile is a cv2.remap of the part of the downscaled diff it reads, with the
+    same pixel mapping cv2.resize uses, so tiles don't need to overlap and there are no seams. peak memory is the
+    input and output buffers plus one tile, whatever the image size. PIL and cv2 only encode whole images, so the
+    output buffer is encoded at the end.
+    :param input_img: uint8 RGB(A)
+    :param ref_img: float32 RGB(A), 0 to 1
+    :return: uint8 or uint16 RGB(A), depending on bit_depth
+    """
+    if scale_factor != 100.0:
+        h, w, _ = get_h_w_c(ref_img)
+        out_dims = (
+            max(ceil(w * (scale_factor / 100)), 1),
+            max(ceil(h * (scale_factor / 100)), 1),
+        )
+        ref_img = cv2.resize(ref_img, out_dims, interpolation=cv2.INTER_AREA)
+        input_h, input_w, input_c = get_h_w_c(input_img)
+        ref_h, ref_w, ref_c = get_h_w_c(ref_img)
+
+        assert (
+                ref_w < input_w and ref_h < input_h
+        ), "Image must be larger than Reference Image"
+        assert input_c in (3, 4), "The input image must be an RGB or RGBA image"
+        assert ref_c in (3, 4), "The reference image must be an RGB or RGBA image"
+
+        # adjust channels, the input's alpha is carried over untouched
+        c = min(input_c, ref_c)
+        downscaled_diff = ref_img[:, :, :c] - downscale_area(input_img, (ref_w, ref_h), c)
+
+        top = 65535 if bit_depth == 16 else 255
+        dtype = np.uint16 if bit_depth == 16 else np.uint8
+        result = np.empty((input_h, input_w, input_c), dtype)
+        tile_rows = min(tile_rows, REMAP_MAX)
+        # source coordinates of every output column and row, like cv2.resize
+        xs = (np.arange(input_w, dtype=np.float64) + 0.5) * (ref_w / input_w) - 0.5
+        ys = (np.arange(input_h, dtype=np.float64) + 0.5) * (ref_h / input_h) - 0.5
+        for y in range(0, input_h, tile_rows):
+            rows = min(tile_rows, input_h - y)
+            # the source rows the tile reads, with room for the cubic's 4 taps
+            y0, y1 = source_span(ys[y:y + rows], ref_h)
+            for x in range(0, input_w, REMAP_MAX):
+                cols = min(REMAP_MAX, input_w - x)
+                x0, x1 = source_span(xs[x:x + cols], ref_w)
+                map_x = np.repeat((xs[x:x + cols] - x0).astype(np.float32)[None, :], rows, axis=0)
+                map_y = np.repeat((ys[y:y + rows] - y0).astype(np.float32)[:, None], cols, axis=1)
+                diff = cv2.remap(downscaled_diff[y0:y1, x0:x1], map_x, map_y, interpolation=cv2.INTER_CUBIC,
+                                 borderMode=cv2.BORDER_REPLICATE)
+                tile = input_img[y:y + rows, x:x + cols, :c].astype(np.float32) / 255
+                tile += diff
+                np.clip(tile, 0, 1, out=tile)
+                result[y:y + rows, x:x + cols, :c] = tile * top
+            if input_c > c:
+                result[y:y + rows, :, c:] = input_img[y:y + rows, :, c:].astype(dtype) * (top // 255)
+        return result
+
+
+def source_span(coordinates, size):
+    """
+    the range of source pixels a cubic remap to `coordinates` reads, 1 before and 2 after each, clamped to the source.
+    outside of it BORDER_REPLICATE only ever repeats real edge pixels, so the crop gives the same result as the whole.
+    """
+    return max(int(np.floor(coordinates[0])) - 1, 0), min(int(np.floor(coordinates[-1])) + 3, size)
+
+
+def to_float(image):
+    """
+    RGB(A) float32 in 0 to 1, half the memory of float64
+    """
+    if image.mode == "L":
+        image = image.convert('RGB')
+    array = np.asarray(image, dtype=np.float32)
+    array *= 1 / 255
+    return array
+
+
+def to_uint8(image):
+    if image.mode == "L":
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def quantize(array, bit_depth=8):
+    if bit_depth == 16:
+        return (array * 65535).astype(np.uint16)
+    return (array * 255).astype(np.uint8)
+
+
+def save(array, path):
+    path.parent.mkdir(exist_ok=True, parents=True)
+    if array.dtype == np.uint16:
+        # PIL can't write 16-bit RGB(A), cv2 can, in BGR(A) order. imencode + tofile for non-ascii paths on windows.
+        array = cv2.cvtColor(array, cv2.COLOR_RGBA2BGRA if array.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+        cv2.imencode('.png', array)[1].tofile(str(path))
+    else:
+        Image.fromarray(array).save(path)
+
+
+def pair(references_path, inputs_path):
+    """
+    match inputs to references by path relative to their directory, ignoring the suffix
+    :return: list of (input path, reference path), and the inputs that have no reference
+    """
+    references = {}
+    for reference_path in references_path.glob('**/*.*'):
+        references[reference_path.relative_to(references_path).with_suffix('').as_posix()] = reference_path
+    pairs, unmatched = [], []
+    for input_path in inputs_path.glob('**/*.*'):
+        reference_path = references.get(input_path.relative_to(inputs_path).with_suffix('').as_posix())
+        if reference_path is None:
+            unmatched.append(input_path)
+        else:
+            pairs.append((input_path, reference_path))
+    return pairs, unmatched
+
+
+def do_the_thing(paths):
+    input_path, reference_path = paths
+    with Image.open(reference_path) as reference_image:
+        reference_array = to_float(reference_image)
+    with Image.open(input_path) as input_image:
+        if tile_rows:
+            output_array = AverageColorFixTiled(to_uint8(input_image), reference_array, scale_factor, bit_depth,
+                                                tile_rows)
         else:
-            print("ref: " + reference_path.name + ", doesn't match input: " + input_path.name)
-            break
+            output_array = quantize(AverageColorFix(to_float(input_image), reference_array, scale_factor), bit_depth)
+    output_path = Path.joinpath(output_root, input_path.relative_to(inputs_root).with_suffix('.png'))
+    save(output_array, output_path)
+
+
+parser = argparse.ArgumentParser(description="Average Color Fix, corrects the colors of upscaled images to match "
+                                             "their reference")
+parser.add_argument('--reference', '-r', metavar='-R', type=str, default='./reference',
+                    help='directory of reference images, default = ./reference')
+parser.add_argument('--input', '-i', metavar='-I', type=str, default='./input',
+                    help='directory of images to be fixed, paired with references by relative path, default = ./input')
+parser.add_argument('--output', '-o', metavar='-O', type=str, default='./output',
+                    help='output directory, default = ./output')
+parser.add_argument('--scale', '-s', metavar='-S', type=float, default=25,
+                    help='percent the reference is downscaled to before comparing, default = 25')
+parser.add_argument('--bit-depth', '-b', metavar='-B', type=int, default=8, choices=[8, 16],
+                    help='output bits per channel, 8 or 16, default = 8')
+parser.add_argument('--tile', '-t', metavar='-T', type=int, default=0,
+                    help='fix the image in strips of this many rows, so memory stays flat for huge images, '
+                         'default = 0 (whole image at once)')
+parser.add_argument('--parallel', '-p', metavar='-P', action=argparse.BooleanOptionalAction,
+                    help='multicore processing')
+parser.add_argument('--multiplier', '-m', metavar='-M', type=float, default=1,
+                    help='if using multicore processing, job multiplier per core. default = 1')
+args = parser.parse_args()
+
+references_root = Path(args.reference)
+inputs_root = Path(args.input)
+output_root = Path(args.output)
+scale_factor = args.scale
+bit_depth = args.bit_depth
+tile_rows = args.tile
+
+if __name__ == '__main__':
+    pairs, unmatched = pair(references_root, inputs_root)
+    for input_path in unmatched:
+        print("no reference for input: " + input_path.as_posix())
+    if args.parallel:
+        handler.parallel_process(pairs, do_the_thing, args.multiplier)
     else:
-        print("ref images count and input images count are not equal.")
+        handler.solo_process(pairs, do_the_thing)
@@ -1,19 +1,75 @@
 from pathlib import Path
+
+import numpy as np
 from PIL import Image
+from scipy.spatial import cKDTree
 
 from packageland import handler
 
+# how many of the reference's most used colors to correct to, i.e. 16. None for all of them
+palette_size = None
 
-def color_transfer(ref_img, in_img):
-    """
-    Designed for grayscale images. Corrects input image's palette to the 16 most used values of
-    reference image's palette. There is a faster way to do this, but eh.
 
+def get_palette(ref_img, top=None):
+    """
+    reference image's colors, most used first
+    :param top: only keep the `top` most used colors
     """
-    ref_colors = ref_img.getcolors()
+    ref_colors = ref_img.getcolors(ref_img.width * ref_img.height)
     ref_colors.sort(reverse=True)
-    # ref_palette = [color[1] for color in ref_colors[:16]]
-    ref_palette = [color[1] for color in ref_colors]
+    return [color[1] for color in ref_colors[:top]]
+
+
+def palette_lut(ref_palette):
+    """
+    nearest palette value for each of the 256 gray levels. argmin takes the first of equally near values, so ties go
+    to the most used one, same as min() over the palette did.
+    """
+    values = np.asarray(ref_palette)
+    distance = np.abs(np.arange(256)[:, None] - values[None, :])
+    return values[np.argmin(distance, axis=1)].tolist()
+
+
+def pack(pixels):
+    """
+    (n, channels) uint8 to one uint32 per pixel
+    """
+    packed = np.zeros(len(pixels), np.uint32)
+    for i in range(pixels.shape[1]):
+        packed |= pixels[:, i].astype(np.uint32) << (8 * i)
+    return packed
+
+
+def unpack(packed, channels):
+    return np.stack([(packed >> (8 * i)) & 0xFF for i in range(channels)], axis=1).astype(np.uint8)
+
+
+def palette_transfer(ref_palette, in_img):
+    """
+    RGB(A) version of the lookup table. each distinct input color is looked up once, in a KD-tree over the palette,
+    in one batched query, then the answers are scattered back to the pixels.
+    """
+    pixels = np.asarray(in_img)
+    channels = pixels.shape[2]
+    colors, inverse = np.unique(pack(pixels.reshape(-1, channels)), return_inverse=True)
+    palette = np.asarray(ref_palette, np.uint8)
+    _, nearest = cKDTree(palette).query(unpack(colors, channels))
+    out = palette[nearest][inverse].reshape(pixels.shape)
+    return Image.fromarray(out, in_img.mode)
+
+
+def color_transfer(ref_img, in_img, top=None):
+    """
+    Corrects input image's palette to the reference image's palette, or to the `top` most used values of it.
+    Grayscale goes through a 256 entry lookup table in one point() pass, RGB and RGBA through palette_transfer. Both
+    images need the same mode.
+
+    """
+    ref_palette = get_palette(ref_img, top)
+    if in_img.mode == 'L' and ref_img.mode == 'L':
+        return in_img.point(palette_lut(ref_palette))
+    if in_img.mode in ('RGB', 'RGBA') and ref_img.mode == in_img.mode:
+        return palette_transfer(ref_palette, in_img)
     out_data = []
     for color in in_img.getdata():
         new_color = min(ref_palette, key=lambda palette_color: abs(palette_color - color))
@@ -29,12 +85,10 @@ def do_the_thing(input_path):
         input_path.stem + '.png')
     input_image = Image.open(input_path)
     reference_image = Image.open(reference_path)
-    if input_image.mode == 'RGB':
-        input_image.convert('L')
-    if reference_image.mode == 'RGB':
-        reference_image.convert('L')
+    if reference_image.mode != input_image.mode:
+        reference_image = reference_image.convert(input_image.mode)
 
-    output_image = color_transfer(reference_image, input_image)
+    output_image = color_transfer(reference_image, input_image, palette_size)
     output_path = Path.joinpath(
         Path('./output'),
         (input_path.relative_to(*input_path.parts[:1]).with_name(input_path.stem + '.png')))
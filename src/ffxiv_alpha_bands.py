@@ -1,4 +1,4 @@
-import gc
+import argparse
 from pathlib import Path
 
 import numpy as np
@@ -7,71 +7,119 @@ from PIL import Image
 from packageland import handler
 
 Image.MAX_IMAGE_PIXELS = None
-unimplemented_list = []
 
-
-def to_bands(img: Image.Image):
+parser = argparse.ArgumentParser(description="FFXIV Alpha Bands, split normal map alpha into dye bands, or paste "
+                                             "upscaled bands back together")
+parser.add_argument('--command', '-c', metavar='-C', type=str, default='split',
+                    help='split (./chara_normal_output/ to ./output/) or paste (./xbr_4x_blend/ to ./output/), '
+                         'default = split')
+parser.add_argument('--bands', '-b', metavar='-B', type=str, default='ffxiv',
+                    help='band layout, a preset (ffxiv) or "count,step,width" where band i is alpha i * step to '
+                         'i * step + width, i.e. "16,0x11,0". default = ffxiv')
+parser.add_argument('--parallel', '-p', metavar='-P', action=argparse.BooleanOptionalAction, default=True,
+                    help='multicore processing, default = on')
+parser.add_argument('--multiplier', '-m', metavar='-M', type=float, default=1,
+                    help='if using multicore processing, job multiplier per core. default = 1')
+args = parser.parse_args()
+command = args.command.lower()
+parallel = args.parallel
+multiplier = args.multiplier
+
+
+def band_spec(count=8, step=0x22, width=0x11):
+    """
+    windows of alpha values per band, inclusive. band i is level i * step and the `width` values above it, and the
+    blend gap up to the next level is shared: the lower half goes to band i, the upper half to band i + 1, meeting in
+    the middle. the defaults are the ffxiv normal map dye encoding.
+    """
     # WRITTEN BY SINOM
-    alpha = np.array(img.split()[3])
-    in_range = lambda array, min, max: (array >= min) & (array <= max)
-
-    values_lo = [0x11, 0x33, 0x55, 0x77, 0x99, 0xBB, 0xDD]
+    gap = step - width
+    mid = gap // 2
+    windows = [[(i * step, i * step + width)] for i in range(count)]
+    for i in range(count - 1):
+        lo = i * step + width
+        # bad ranges
+        windows[i].append((lo + 1, lo + gap - mid))
+        windows[i + 1].append((lo + mid, lo + gap - 1))
+    return windows
+
+
+def compile_bands(windows):
+    """
+    for each band, a 256 entry point() table of the alpha values that belong to it (255) or not (0). built once, so
+    no image ever needs range masks.
+    """
+    alpha = np.arange(256)
+    tables = []
+    for band in windows:
+        table = np.zeros(256, np.uint8)
+        for low, high in band:
+            table[(alpha >= low) & (alpha <= high)] = 255
+        tables.append(table.tolist())
+    return tables
+
+
+def read_bands(bands):
+    """
+    :param bands: name of a preset from BAND_SPECS, or "count,step,width", i.e. "16,0x11,0"
+    """
+    if bands.lower() in BAND_SPECS:
+        return band_spec(*BAND_SPECS[bands.lower()])
+    return band_spec(*[int(value, 0) for value in bands.split(',')])
+
+
+BAND_SPECS = {'ffxiv': (8, 0x22, 0x11)}
+band_tables = compile_bands(read_bands(args.bands))
 
-    mid = 0x11 // 2
-    # bad range0s masks
-    u_masks = [in_range(alpha, a + 1, (a + 0x11) - mid) for a in values_lo]
-    d_masks = [in_range(alpha, a + mid, (a + 0x11) - 1) for a in values_lo]
-    # good ranges masks
-    masks = [in_range(alpha, a, a + 0x11) for a in [x * 0x22 for x in range(0, 8)]]
 
-    bands = [np.zeros(alpha.shape, alpha.dtype) for _ in range(0, 8)]
-    white = np.full(alpha.shape, 255, alpha.dtype)
-
-    for i, mask in enumerate(masks):
-        np.putmask(bands[i], mask, white)
+def to_bands(img: Image.Image):
+    alpha = img.getchannel(3)
+    # one point() per band, a table lookup in C, and the alpha split only once
+    return [Image.merge("RGBA", (alpha, alpha, alpha, alpha.point(table))) for table in band_tables]
 
-    for i, mask in enumerate(u_masks):
-        np.putmask(bands[i], mask, white)
 
-    for i, mask in enumerate(d_masks):
-        np.putmask(bands[i + 1], mask, white)
+threshold = 254  # theoretically might need this later
+THRESHOLD_TABLE = [255 if value > threshold else 0 for value in range(256)]
 
-    rgba = []
-    for band in bands:
-        band = Image.fromarray(band, 'L')
-        rgba.append(Image.merge("RGBA", (img.split()[3], img.split()[3], img.split()[3], band)))
 
-    return rgba
+def band_paths(dir):
+    """
+    :return: the dye map, and the bands in order
+    """
+    paths = [path for path in dir.glob("*") if path.is_file()]
+    bands = sorted((path for path in paths if path.stem.isdigit()), key=lambda path: int(path.stem))
+    dye_map = [path for path in paths if not path.stem.isdigit()][0]
+    return dye_map, bands
 
 
-def paste_bands(source, bands):
-    for band in bands:
-        source.paste(band, (0, 0), band)
-    gc.collect()
-    return source
+def threshold_alpha(image):
+    if len(image.getbands()) == 4:
+        image.putalpha(image.getchannel(3).point(THRESHOLD_TABLE))
+    return image
 
 
 def do_thing_paste(dir):
-    XBR_bands = []
-    paths = list(dir.glob("*"))
-    threshold = 254  # theoretically might need this later
-    for path in paths:
-        with Image.open(path) as image:
-            try:
-                alpha = image.split()[3]
-                alpha = alpha.point(lambda p: p > threshold and 255)
-                image.putalpha(alpha)
-            except IndexError:
-                pass
-            XBR_bands.append(image)
-    output_image = paste_bands(XBR_bands[8], XBR_bands[:8])
-    del XBR_bands
-    output_image.save("output/" + str(dir.name) + ".png", compress_level=1)
-    output_image.close()
-    gc.collect()
+    """
+    paste the bands over the dye map one at a time, so only the output and one band are in memory
+    """
+    dye_map, paths = band_paths(dir)
+    if len(paths) != len(band_tables):
+        raise ValueError(str(dir) + ": expected " + str(len(band_tables)) + " bands, found " + str(len(paths)))
+    output_path = Path.joinpath(Path('./output'), dir.name + ".png")
+    output_path.parent.mkdir(exist_ok=True, parents=True)
+    with Image.open(dye_map) as output_image:
+        threshold_alpha(output_image)
+        for path in paths:
+            with Image.open(path) as band:
+                threshold_alpha(band)
+                output_image.paste(band, (0, 0), band)
+        output_image.save(output_path, compress_level=1)
 
 
 def do_thing_split(path):
+    """
+    :return: the file name if PIL can't read its format
+    """
     try:
         with Image.open(path) as image:
             with image.split()[3] as alpha:
@@ -83,22 +131,22 @@ def do_thing_split(path):
                 band.save(Path.joinpath(output_path, Path(str(i) + ".png")))
             del bands
     except NotImplementedError:
-        unimplemented_list.append(path.name)
-
+        return path.name
 
-# for path in tqdm(normals_list, desc="Folders Processed"):
-#
 
 if __name__ == '__main__':
-    XBR_path = Path('./xbr_4x_blend/')
-    XBR_directories = list(filter(lambda path: path.is_dir(), XBR_path.glob('*')))
-    normals_path = Path('./chara_normal_output/')
-    normals_list = list(normals_path.glob('**/*.*'))
-    parallel = True
+    if command == 'paste':
+        XBR_path = Path('./xbr_4x_blend/')
+        items = list(filter(lambda path: path.is_dir(), XBR_path.glob('*')))
+        function = do_thing_paste
+    else:
+        normals_path = Path('./chara_normal_output/')
+        items = list(normals_path.glob('**/*.*'))
+        function = do_thing_split
     if parallel:
-        handler.parallel_process(normals_list, do_thing_split, 1)
-        for item in unimplemented_list:
-            print(item)
-
+        results = handler.parallel_process(items, function, multiplier)
     else:
-        handler.solo_process(normals_list, do_thing_split)
+        results = handler.solo_process(items, function)
+    unimplemented_list = [result for result in results if isinstance(result, str)]
+    for item in unimplemented_list:
+        print(item)
@@ -0,0 +1,81 @@
+import argparse
+import csv
+from pathlib import Path
+import numpy as np
+
+from packageland import channels, features, handler
+from PIL import Image
+
+Image.MAX_IMAGE_PIXELS = None
+parser = argparse.ArgumentParser(description="Heuristic Features, channel difference features of every image, for "
+                                             "trying heuristics without reading the images again")
+parser.add_argument('--directory', '-d', metavar='-D', type=str, help='Initial directory to be processed.',
+                    required=True)
+parser.add_argument('--output', '-o', metavar='-O', type=str, default=None,
+                    help='directory of the feature matrix, see packageland.features.load. default = '
+                         '[directory]_features')
+parser.add_argument('--tolerance', '-t', metavar='-T', type=float, default=9,
+                    help='channels that differ by at most this count as the same for the percent features, default = 9')
+parser.add_argument('--csv', metavar='-CSV', type=str, default=None,
+                    help='also write path, normalized r-g, r-b, g-b here, i.e. output_normalized.csv for '
+                         'heuristic_values')
+parser.add_argument('--parallel', '-p', metavar='-P', action=argparse.BooleanOptionalAction,
+                    help='multicore processing')
+parser.add_argument('--multiplier', '-m', metavar='-M', type=float, default=5,
+                    help='if using multicore processing, job multiplier per core. default = 5')
+parser.add_argument('--scheduler', '-s', metavar='-S', type=str, default='stream',
+                    help='if using multicore processing, "stream" (one pool for the whole run) or "chunk" (one pool per '
+                         'chunk), default = stream')
+parser.add_argument('--largest-first', '-l', metavar='-L', action=argparse.BooleanOptionalAction,
+                    help='if using multicore processing, dispatch the largest images first')
+parser.add_argument('--memory-budget', '-b', metavar='-B', type=float, default=None,
+                    help='if using multicore processing, max MiB of decoded images in flight at once, default = no limit')
+args = parser.parse_args()
+
+p = Path(args.directory)
+output = Path(args.output or str(p) + '_features')
+tolerance = args.tolerance
+parallel = args.parallel
+multiplier = args.multiplier
+scheduler = args.scheduler
+largest_first = args.largest_first
+memory_budget = None if args.memory_budget is None else int(args.memory_budget * 2 ** 20)
+
+
+def extract(image_path):
+    with Image.open(image_path) as image:
+        pixels = channels.rgb(image)
+    return channels.features(pixels, tolerance)
+
+
+def write_csv(path, grabber, matrix):
+    """
+    the normalized differences, in the layout heuristic_values reads
+    """
+    normalized = [channels.FEATURES.index('normalized ' + pair) for pair in channels.PAIR_NAMES]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Path', 'Average(R-G)/Brightness', 'Average(R-B)/Brightness', 'Average(G-B)/Brightness'])
+        for image_path, row in zip(grabber, matrix[:, normalized]):
+            # black images have no brightness to normalize by, and failed ones no row
+            if np.isfinite(row).all():
+                writer.writerow([image_path.as_posix()] + row.tolist())
+
+
+if __name__ == '__main__':
+    grabber = list(p.glob('**/*.*'))
+    matrix = features.create(output, grabber, channels.FEATURES)
+    rows = {image_path: row for row, image_path in enumerate(grabber)}
+
+    def fill(image_path, result):
+        # straight into the memmap as each image finishes
+        if not isinstance(result, handler.Failure):
+            matrix[rows[image_path]] = result
+
+    if parallel:
+        handler.parallel_process(grabber, extract, multiplier, scheduler, largest_first, memory_budget, fill)
+    else:
+        handler.solo_process(grabber, extract, fill)
+    matrix.flush()
+    if args.csv:
+        write_csv(args.csv, grabber, matrix)
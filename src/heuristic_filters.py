@@ -1,10 +1,13 @@
 import argparse
-import shutil
 from pathlib import Path
 import numpy as np
 
 from packageland import handler
-from PIL import Image, ImageStat
+from packageland.unique_colors import count as count_unique_colors
+from packageland.histogram_cache import HistogramCache
+from packageland.links import LINK_MODES, place
+from packageland.results import Results
+from PIL import Image
 
 Image.MAX_IMAGE_PIXELS = None
 # todo: make this less stupid with the operators and commands in general. subparsers I think?
@@ -12,30 +15,45 @@ parser = argparse.ArgumentParser(description="Heuristic Filters, Filter images b
 parser.add_argument('--directory', '-d', metavar='-D', type=str, help='Initial directory to be processed.',
                     required=True)
 parser.add_argument('--command', '-c', metavar='-C', type=str,
-                    help='variance_range, mean_range, stddev_mean. threshold_mean, median_mean, unique_colors, f_test',
-                    required=True)
+                    help='variance_range, mean_range, stddev_mean. threshold_mean, median_mean, mode_mean, unique_colors, '
+                         'f_test')
+parser.add_argument('--predicate', '-f', metavar='-F', type=str, action='append',
+                    help='command:operator:threshold, i.e "variance_range:gt:100", can be given many times to run them '
+                         'all in one pass. output goes to [directory][command][operator]_[threshold] per predicate. '
+                         'operator and threshold default to --operator and --threshold')
 parser.add_argument('--parallel', '-p', metavar='-P', action=argparse.BooleanOptionalAction,
                     help='multicore processing')
 parser.add_argument('--threshold', '-t', metavar='-T', type=float, default=128,
                     help='threshold between 0 to 255, default=128')
 parser.add_argument('--multiplier', '-m', metavar='-M', type=float, default=5,
                     help='if using multicore processing, job multiplier per core. default = 5')
+parser.add_argument('--scheduler', '-s', metavar='-S', type=str, default='stream',
+                    help='if using multicore processing, "stream" (one pool for the whole run) or "chunk" (one pool per '
+                         'chunk), default = stream')
+parser.add_argument('--largest-first', '-l', metavar='-L', action=argparse.BooleanOptionalAction,
+                    help='if using multicore processing, dispatch the largest images first')
+parser.add_argument('--memory-budget', '-b', metavar='-B', type=float, default=None,
+                    help='if using multicore processing, max MiB of decoded images in flight at once, default = no limit')
 parser.add_argument('--operator', '-o', metavar='-O', type=str, default="gt",
                     help='use bash integer comparison style, i.e "gt","lt", default = "gt"')
+parser.add_argument('--link-mode', '-k', metavar='-K', type=str, default='copy', choices=LINK_MODES,
+                    help='how matched images are put in the output, copy, hardlink, symlink or reflink. falls back to '
+                         'copy where the link can\'t be made. default = copy')
+parser.add_argument('--cache', metavar='-CACHE', action=argparse.BooleanOptionalAction, default=True,
+                    help='keep histograms in [directory]_histograms.sqlite, so later runs with other thresholds and '
+                         'operators don\'t decode the images again. default = on')
+parser.add_argument('--results', '-r', metavar='-R', type=str, default=None,
+                    help='write which images matched which predicate here, a directory of .npz chunks (see '
+                         'packageland.results.load), or a csv if it ends in .csv')
+parser.add_argument('--no-output', action='store_true',
+                    help='don\'t place the matched images, i.e. to only write --results')
 args = parser.parse_args()
 
 np.seterr(all='raise')
-
-
-def compare_with_threshold(variable):
-    if operator == "ge":
-        return variable >= threshold
-    if operator == "le":
-        return variable <= threshold
-    if operator == "gt":
-        return variable > threshold
-    if operator == "lt":
-        return variable < threshold
+OPERATORS = ['ge', 'le', 'gt', 'lt', 'eq', 'ne']
+# images whose statistics are computed at once, bounds the temporaries of histogram_stats
+BATCH = 4096
+LEVELS = np.arange(256, dtype=np.uint64)
 
 
 def make_path(path, d_suffix):
@@ -44,39 +62,53 @@ def make_path(path, d_suffix):
     return out_path
 
 
-def is_variance_range(image_path):
+def histogram_stats(histograms, needed):
+    """
+    ImageStat's statistics, plus mode, for a stack of histograms with the same number of bands, all at once. the
+    sums stay in the histograms' integer dtype, only the (images, bands) results are floats.
+    :param histograms: (images, bands * 256)
+    :param needed: which of mean, var, stddev, median and mode to compute
+    :return: dict of (images, bands) arrays
+    """
+    h = np.asarray(histograms).reshape(len(histograms), -1, 256)
+    stats = {}
+    pixels = h.sum(axis=2)
+    count = pixels.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if needed & {'mean', 'var', 'stddev'}:
+            total = (h @ LEVELS).astype(np.float64)
+            stats['mean'] = total / count
+        if needed & {'var', 'stddev'}:
+            total2 = (h @ LEVELS ** 2).astype(np.float64)
+            stats['var'] = np.maximum((total2 - total ** 2 / count) / count, 0)
+            stats['stddev'] = np.sqrt(stats['var'])
+    if 'median' in needed:
+        # first level where the running count passes half, per band
+        stats['median'] = np.argmax(np.cumsum(h, axis=2) > (pixels // 2)[:, :, None], axis=2)
+    if 'mode' in needed:
+        stats['mode'] = np.argmax(h, axis=2)
+    return stats
+
+
+def is_variance_range(stats, operator, threshold):
     """
     sort of like an f test, if the range is between channels' variance is high it tells us that the image is likely a
     composite/multi image.
     """
-    with Image.open(image_path) as image:
-        histogram = image.histogram()
-        variance = ImageStat.Stat(histogram).var
-        if np.any(variance):
-            #normalized_variance = variance / np.linalg.norm(variance)
-            #variance_range = (max(normalized_variance) - min(normalized_variance))
-            variance_range = max(variance) - min(variance)
-        else:
-            variance_range = 0
-        result = compare_two_values(variance_range, threshold)
-    return result
-
-
-def is_mean_range(image_path):
-    with Image.open(image_path) as image:
-        histogram = image.histogram()
-        mean = ImageStat.Stat(histogram).mean
-        if np.any(mean):
-            #normalized_variance = mean / np.linalg.norm(mean)
-            #mean_range = (max(normalized_variance) - min(normalized_variance))
-            mean_range = max(mean)-min(mean)
-        else:
-            mean_range = 0
-        result = compare_two_values(mean_range, threshold)
-    return result
-
-
-def compare_two_values(var1, var2):
+    variance = stats['var']
+    #normalized_variance = variance / np.linalg.norm(variance)
+    #variance_range = (max(normalized_variance) - min(normalized_variance))
+    variance_range = variance.max(axis=1) - variance.min(axis=1)
+    return compare_two_values(variance_range, threshold, operator)
+
+
+def is_mean_range(stats, operator, threshold):
+    mean = stats['mean']
+    mean_range = mean.max(axis=1) - mean.min(axis=1)
+    return compare_two_values(mean_range, threshold, operator)
+
+
+def compare_two_values(var1, var2, operator):
     if operator == "ge":
         return var1 >= var2
     if operator == "le":
@@ -89,71 +121,68 @@ def compare_two_values(var1, var2):
         return var1 == var2
     if operator == "ne":
         return var1 != var2
+    raise ValueError('unknown operator: ' + str(operator))
 
 
-def stddev_mean(image_path):
-    with Image.open(image_path) as image:
-        histogram = image.histogram()
-        mean, stddev = np.asarray(ImageStat.Stat(histogram).mean), np.asarray(ImageStat.Stat(histogram).stddev)
-        result = compare_two_values(stddev, mean)
-        return result
+def stddev_mean(stats, operator, threshold):
+    return compare_two_values(stats['stddev'], stats['mean'], operator).any(axis=1)
 
 
-def median_mean(image_path):
-    with Image.open(image_path) as image:
-        histogram = image.histogram()
-        mean, median = np.asarray(ImageStat.Stat(histogram).mean), np.asarray(ImageStat.Stat(histogram).median)
-        result = compare_two_values(median, mean)
-        return result
+def median_mean(stats, operator, threshold):
+    return compare_two_values(stats['median'], stats['mean'], operator).any(axis=1)
 
 
-def mode_mean(image_path):
-    with Image.open(image_path) as image:
-        histogram = image.histogram()
-        mean, mode = np.asarray(ImageStat.Stat(histogram).mean), np.asarray(ImageStat.Stat(histogram).mode)
-        result = compare_two_values(mode, mean)
-        return result
+def mode_mean(stats, operator, threshold):
+    return compare_two_values(stats['mode'], stats['mean'], operator).any(axis=1)
 
 
-def threshold_mean(image_path):
-    with Image.open(image_path) as image:
-        histogram = image.histogram()
-        mean = np.asarray(ImageStat.Stat(histogram).mean)
-        result = compare_two_values(threshold, mean)
-        return result
+def threshold_mean(stats, operator, threshold):
+    return compare_two_values(threshold, stats['mean'], operator).any(axis=1)
 
 
-def do_f_test(image_path):
+def do_f_test(stats, operator, threshold):
     """
     normally you would use this instead of ranges but division is expensive, and I'm already using python.
     """
-    with Image.open(image_path) as image:
-        histogram = image.histogram()
-        variance = ImageStat.Stat(histogram).var
-        normalized_variance = variance / np.linalg.norm(variance)
-        f_value = (max(normalized_variance) / min(normalized_variance))
-        result = compare_two_values(f_value)
-    return result
+    variance = stats['var']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized_variance = variance / np.linalg.norm(variance, axis=1)[:, None]
+        f_value = normalized_variance.max(axis=1) / normalized_variance.min(axis=1)
+    return compare_two_values(f_value, threshold, operator)
+
+
+def unique_colors(stats, operator, threshold):
+    return compare_two_values(stats['unique_colors'], threshold, operator)
+
+
+# the statistics each command reads
+NEEDS = {is_variance_range: {'var'}, is_mean_range: {'mean'}, stddev_mean: {'stddev', 'mean'},
+         median_mean: {'median', 'mean'}, mode_mean: {'mode', 'mean'}, threshold_mean: {'mean'}, do_f_test: {'var'},
+         unique_colors: set()}
 
 
-def get_unique_colors(image_path):
+def evaluate(predicates, histograms, colors):
     """
-    I just googled some fast ways to do this. method 1 is fast, but sometimes gets a memory error, so if that happens
-    we use method 2, which is like 4x slower.
+    run every predicate over every image, grouped by number of bands and in batches of BATCH images, computing only
+    the statistics the predicates read
+    :param predicates: (function, d_suffix, operator, threshold)
+    :param histograms: one histogram per image, None for the ones that couldn't be read
+    :param colors: unique colors per image, nan where not counted
+    :return: bool array (images, predicates), which images matched which predicate
     """
-    # https://stackoverflow.com/questions/59669715/fastest-way-to-find-the-rgb-pixel-color-count-of-image/59671950#59671950
-    with Image.open(image_path).convert('RGB') as img:
-        na = np.array(img)
-        # size = np.average([img.width, img.height])
-    try:
-        f = np.dot(na.astype(np.uint32), [1, 256, 65536])
-        colors = len(np.unique(f))
-    except np.core._exceptions._ArrayMemoryError:
-        colors = np.unique(na.reshape(-1, na.shape[2]), axis=0)
-        # waaaaaaaaaaaaaaaaaaaaaay slower
-    # result = size < threshold * colors
-    result = colors > threshold
-    return result
+    needed = set().union(*[NEEDS[predicate[0]] for predicate in predicates])
+    matched = np.zeros((len(histograms), len(predicates)), bool)
+    by_size = {}
+    for i, histogram in enumerate(histograms):
+        if histogram is not None:
+            by_size.setdefault(len(histogram), []).append(i)
+    for group in by_size.values():
+        for indices in handler.chunks(group, BATCH):
+            stats = histogram_stats([histograms[i] for i in indices], needed) if needed else {}
+            stats['unique_colors'] = colors[indices]
+            for j, (function, _, operator, threshold) in enumerate(predicates):
+                matched[indices, j] = function(stats, operator, threshold)
+    return matched
 
 
 def read_command(command):
@@ -169,38 +198,119 @@ def read_command(command):
         return do_f_test, "_f_test_"
     if "median_mean" == command.lower():
         return median_mean, "_median_mean_"
+    if "mode_mean" == command.lower():
+        return mode_mean, "_mode_mean_"
     if "unique_colors" == command.lower():
-        return get_unique_colors, "_unique_colors_"
+        return unique_colors, "_unique_colors_"
+
+
+def read_predicate(predicate):
+    """
+    "command:operator:threshold", operator and threshold default to --operator and --threshold
+    :return: (function, d_suffix, operator, threshold)
+    """
+    name, _, rest = predicate.partition(':')
+    operator, _, threshold = rest.partition(':')
+    operator = operator or args.operator
+    threshold = float(threshold) if threshold else args.threshold
+    if read_command(name) is None or operator not in OPERATORS:
+        parser.error('can\'t read predicate: ' + predicate)
+    function, suffix = read_command(name)
+    return function, suffix + operator + '_' + str(threshold).replace('.', '-'), operator, threshold
 
 
 p = Path(args.directory)
 parallel = args.parallel
 multiplier = args.multiplier
-threshold = args.threshold
-operator = args.operator
-command = read_command(args.command)
+scheduler = args.scheduler
+largest_first = args.largest_first
+memory_budget = None if args.memory_budget is None else int(args.memory_budget * 2 ** 20)
+link_mode = args.link_mode
+cache_path = Path(str(p) + '_histograms.sqlite')
+if args.predicate:
+    predicates = [read_predicate(predicate) for predicate in args.predicate]
+elif args.command:
+    command = read_command(args.command)
+    if command is None:
+        parser.error('unknown command: ' + args.command)
+    predicates = [(command[0], command[1] + str(args.threshold).replace('.', '-'), args.operator, args.threshold)]
+else:
+    parser.error('one of --command or --predicate is required')
+# only decode what the predicates need
+count_colors = any(predicate[0] is unique_colors for predicate in predicates)
+# past the biggest threshold every comparison is already decided, so counting can stop there
+colors_limit = max([predicate[3] for predicate in predicates if predicate[0] is unique_colors], default=None)
+
+
+def measure(image_path):
+    """
+    one decode per image, the histogram and, if any predicate wants it, the number of unique colors
+    """
+    with Image.open(image_path) as image:
+        histogram = np.asarray(image.histogram(), np.uint64)
+        colors = count_unique_colors(image, colors_limit) if count_colors else None
+    return histogram, colors
 
 
-def image_handler(image_path):
-    function = command[0]
-    suffix = command[1] + str(threshold).replace('.', '-')
-    output_path = make_path(image_path, suffix)
+def place_match(match):
+    image_path, d_suffix = match
+    output_path = make_path(image_path, d_suffix)
     output_path.parent.mkdir(exist_ok=True, parents=True)
-    result = function(image_path)
+    place(image_path, output_path, link_mode)
+
+
+def run(items, function, callback=None, decoding=True):
+    """
+    :param decoding: whether `items` are images to decode, the size based scheduling only makes sense for those
+    """
+    if parallel:
+        if decoding:
+            return handler.parallel_process(items, function, multiplier, scheduler, largest_first, memory_budget,
+                                            callback)
+        return handler.parallel_process(items, function, multiplier, scheduler, callback=callback)
+    return handler.solo_process(items, function, callback)
+
+
+def write_results(path, grabber, predicates, matched):
+    results = Results(path, [('Path', str)] + [(p.name + predicate[1], bool) for predicate in predicates])
+    try:
+        for image_path, row in zip(grabber, matched):
+            results.append([image_path.as_posix()] + row.tolist())
+    finally:
+        results.close()
+
+
+def filter_handler(grabber):
+    """
+    histograms from the cache where it has them, decoded in the workers where it doesn't, then every predicate over
+    all of them at once and each image placed in the output of every predicate it matched
+    """
+    cache = HistogramCache(cache_path) if args.cache else None
+    histograms = [cache.get(image_path) for image_path in grabber] if cache else [None] * len(grabber)
+    colors = np.full(len(grabber), np.nan)
+    missing = [i for i, histogram in enumerate(histograms) if histogram is None or count_colors]
+
+    def store(image_path, result):
+        if cache and not isinstance(result, handler.Failure):
+            cache.put(image_path, result[0])
+
     try:
-        if 1 in result:
-            shutil.copy(image_path, output_path)
-    except TypeError:
-        if result == 1:
-            shutil.copy(image_path, output_path)
+        results = run([grabber[i] for i in missing], measure, store)
+    finally:
+        if cache:
+            cache.close()
+    for i, result in zip(missing, results):
+        if not isinstance(result, handler.Failure):
+            histograms[i] = result[0]
+            colors[i] = np.nan if result[1] is None else result[1]
+    matched = evaluate(predicates, histograms, colors)
+    if args.results:
+        write_results(args.results, grabber, predicates, matched)
+    if not args.no_output:
+        run([(grabber[i], predicates[j][1]) for i, j in zip(*np.nonzero(matched))], place_match, decoding=False)
 
 
 if __name__ == '__main__':
 
     grabber = list(p.glob('**/*.*'))
-    function = image_handler
-    if parallel:
-        handler.parallel_process(grabber, function, multiplier)
-
-    else:
-        handler.solo_process(grabber, function)
+    filter_handler(grabber)
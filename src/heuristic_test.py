@@ -1,11 +1,11 @@
 import argparse
-import csv
-import shutil
 from pathlib import Path
 import numpy as np
 from scipy.stats import chisquare
 
-from packageland import handler
+from packageland import channels, handler
+from packageland.links import LINK_MODES, place
+from packageland.results import Results
 from PIL import Image, ImageStat
 
 parser = argparse.ArgumentParser(description="Heuristic Filters, Filter images by histogram based heuristics")
@@ -16,8 +16,18 @@ parser.add_argument('--parallel', '-p', metavar='-P', action=argparse.BooleanOpt
                     help='multicore processing')
 parser.add_argument('--multiplier', '-m', metavar='-M', type=float, default=5,
                     help='if using multicore processing, job multiplier per core. default = 5')
-# parser.add_argument('--tolerance', '-t', metavar='-T', type=float, default=10,
-#                     help='absolute tolerance value between 0 and infinity, default = 10')
+parser.add_argument('--tolerance', '-t', metavar='-T', type=float, nargs='+', default=[9],
+                    help='absolute tolerance value between 0 and infinity, more than one sorts the images for every '
+                         'tolerance from one read of each image, default = 9')
+parser.add_argument('--percent', metavar='-PERCENT', action=argparse.BooleanOptionalAction,
+                    help='also write the percent of pixels that are the same within each tolerance, per channel pair')
+parser.add_argument('--link-mode', '-k', metavar='-K', type=str, default='copy', choices=LINK_MODES,
+                    help='how gray images, and channels already written for another tolerance, are put in the output, '
+                         'copy, hardlink, symlink or reflink. falls back to copy where the link can\'t be made. '
+                         'default = copy')
+parser.add_argument('--results', '-r', metavar='-R', type=str, default='output_status',
+                    help='where the results table goes, a directory of .npz chunks (see packageland.results.load), or '
+                         'a csv if it ends in .csv. default = output_status')
 args = parser.parse_args()
 
 np.seterr(all='raise')
@@ -30,7 +40,8 @@ def save(image, path):
 
 
 def make_path(path, d_suffix, tolerance):
-    out_folder = Path(str(p.name) + "_" + d_suffix + "_" + str(tolerance).replace('.', '-'))
+    # 9 and 9.0 are the same tolerance and go in the same directory, 9.5 goes in _9-5
+    out_folder = Path(str(p.name) + "_" + d_suffix + "_" + format(tolerance, 'g').replace('.', '-'))
     out_path = Path.joinpath(out_folder, path.name)
     return out_path
 
@@ -41,50 +52,11 @@ def get_brightness(image):
     return stat.rms[0]
 
 
-def get_channels(image):
-    r = np.asarray(image.getchannel('R')).astype(int)
-    g = np.asarray(image.getchannel('G')).astype(int)
-    b = np.asarray(image.getchannel('B')).astype(int)
-    result = r, g, b
-    return result
-
-
-def has_data(image):
-    r = 1
-    g = 1
-    b = 1
-    if len(image.getchannel('R').getcolors()) == 1:
-        r = 0
-    if len(image.getchannel('G').getcolors()) == 1:
-        g = 0
-    if len(image.getchannel('B').getcolors()) == 1:
-        b = 0
-    return [r, g, b]
-
-
-def get_percent_same(r, g, b, tolerance):
-    r_g = np.sum(np.isclose(r, g, atol=tolerance) / r.size)
-    r_b = np.sum(np.isclose(r, b, atol=tolerance) / r.size)
-    g_b = np.sum(np.isclose(g, b, atol=tolerance) / r.size)
-    return r_g, r_b, g_b
-
-
-def get_mse(r, g, b):
-    r_g = np.mean((r - g) ** 2)
-    r_b = np.mean((r - b) ** 2)
-    g_b = np.mean((g - b) ** 2)
-    return r_g, r_b, g_b
-
-
-def get_same(r, g, b, tolerance):
-    r_g = np.allclose(r, g, atol=tolerance, rtol=0)
-    r_b = np.allclose(r, b, atol=tolerance, rtol=0)
-    g_b = np.allclose(g, b, atol=tolerance, rtol=0)
-    return r_g, r_b, g_b
-
-
-def save_channel(channel, image_path, image, is_data, tolerance):
-    channel_data = image.getchannel(channel)
+def save_channel(channel, image_path, plane, is_data, tolerance, written):
+    """
+    :param written: {suffix: path} of the planes already encoded for this image, under another tolerance. those are
+    placed instead of encoded again.
+    """
     if is_data:
         suffix = channel + "_" + "D"
     else:
@@ -92,56 +64,54 @@ def save_channel(channel, image_path, image, is_data, tolerance):
     # suffix = channel
     output_path = make_path(image_path, suffix, tolerance)
     output_path.parent.mkdir(exist_ok=True, parents=True)
-    save(channel_data, output_path)
+    if suffix in written:
+        place(written[suffix], output_path.with_suffix('.png'), link_mode)
+    else:
+        save(Image.fromarray(plane), output_path)
+        written[suffix] = output_path.with_suffix('.png')
     return suffix
 
 
-def sort_image(image_path, tolerance):
+def sort_image(image_path, tolerances):
     """
-    sort RGB into "Y_D, Y_E, R_D, R_E, G_D, G_E, B_D, B_E" based on a_tol
-    :param tolerance:
+    sort RGB into "Y_D, Y_E, R_D, R_E, G_D, G_E, B_D, B_E" based on a_tol, for every tolerance from one decode
+    :param tolerances:
     :param image_path:
-    :return: tolerance value, bool[r_g, r_b, g_b], bool[data]
+    :return: per tolerance, [tolerance value, bool[r_g, r_b, g_b], bool[data], status] and percent same[r_g, r_b, g_b]
+    if --percent
     """
     with Image.open(image_path) as image:
-        r, g, b = get_channels(image)
-        data = has_data(image)
-    same = get_same(r, g, b, tolerance)
-    # percent = get_percent_same(r, g, b)
-    # mse = get_mse(r, g, b)
-    # avg = np.mean(r - g), np.mean(g - b), np.mean(b - g)
-    # std = np.std(r - g), np.std(g - b), np.std(b - g)
-    del r, g, b
-    status = []
-    # don't use relative tolerance, except for the default which is 1e-05
-    # don't use confint as will allow spec of color somewhere like : monsterm0053objbodyb0001texturev02_m0053b0001_c_s.png
-    if all(same):
-        if data == [0, 0, 0]:
-            suffix = "Y_E"
+        pixels = channels.rgb(image)
+    # np.allclose(atol=tolerance, rtol=0) is max|a - b| <= tolerance, so the max differences answer every tolerance.
+    # with just one, the scan can stop once the answer can't change
+    early_exit = tolerances[0] if len(tolerances) == 1 and not percent else None
+    max_diff, data, histograms = channels.scan(pixels, early_exit, percent)
+    written = {}
+    rows = []
+    for tolerance in tolerances:
+        same = [diff <= tolerance for diff in max_diff]
+        status = []
+        # don't use relative tolerance, except for the default which is 1e-05
+        # don't use confint as will allow spec of color somewhere like : monsterm0053objbodyb0001texturev02_m0053b0001_c_s.png
+        if all(same):
+            if data == [0, 0, 0]:
+                suffix = "Y_E"
+            else:
+                suffix = "Y_D"
+            # suffix = "Y"
+            output_path = make_path(image_path, suffix, tolerance)
+            output_path.parent.mkdir(exist_ok=True, parents=True)
+            place(image_path, output_path, link_mode)
+            status.append(suffix)
         else:
-            suffix = "Y_D"
-        # suffix = "Y"
-        output_path = make_path(image_path, suffix, tolerance)
-        output_path.parent.mkdir(exist_ok=True, parents=True)
-        shutil.copy(image_path, output_path)
-        status.append(suffix)
-    else:
-        with Image.open(image_path) as image:
-            status.append(save_channel('R', image_path, image, data[0], tolerance))
-            status.append(save_channel('G', image_path, image, data[1], tolerance))
-            status.append(save_channel('B', image_path, image, data[2], tolerance))
-        # if data == [1, 1, 1]:
-        #     suffix = "RGB_D"
-        #     output_path = make_path(image_path, suffix, tolerance)
-        #     output_path.parent.mkdir(exist_ok=True, parents=True)
-        #     shutil.copy(image_path, output_path)
-        # suffix = "RGB"
-        # output_path = make_path(image_path, suffix, tolerance)
-        # output_path.parent.mkdir(exist_ok=True, parents=True)
-        # shutil.copy(image_path, output_path)
-    return [tolerance, same[0], same[1], same[2], data[0], data[1], data[2], status]
-    # return [percent[0], percent[1], percent[2], data[0], data[1], data[2], avg[0], avg[1], avg[2], std[0],
-    #         std[1], std[2], mse[0], mse[1], mse[2], suffix]
+            # the planes from the one decode above
+            for i, channel in enumerate('RGB'):
+                status.append(save_channel(channel, image_path, pixels[..., i], data[i], tolerance, written))
+        row = [tolerance, same[0], same[1], same[2], data[0], data[1], data[2], status]
+        if percent:
+            row += channels.percent_within(histograms, tolerance)
+        rows.append(row)
+    return rows
 
 
 def read_command(command):
@@ -153,29 +123,44 @@ p = Path(args.directory)
 parallel = args.parallel
 multiplier = args.multiplier
 command = read_command(args.command)
-# tolerance = args.tolerance
-dict_3d = {}
+tolerances = args.tolerance
+percent = args.percent
+link_mode = args.link_mode
 
 
 def image_handler(image_path):
     function = command[0]
-    # for i in range(25):
-    #     result = function(image_path, tolerance=i)
-    result = function(image_path, tolerance=9)
-    dict_3d[image_path.as_posix()] = result
+    result = function(image_path, tolerances=tolerances)
+    return result
+
+
+def columns():
+    """
+    the schema of the results table, one row per image and tolerance
+    """
+    schema = [('Path', str), ('tolerance', np.float32), ('same r-g', bool), ('same r-b', bool), ('same g-b', bool),
+              ('data r', np.uint8), ('data g', np.uint8), ('data b', np.uint8), ('Classification', str)]
+    if percent:
+        schema += [('percent r-g', np.float32), ('percent r-b', np.float32), ('percent g-b', np.float32)]
+    return schema
 
 
 if __name__ == '__main__':
     grabber = list(p.glob('**/*.*'))
     function = image_handler
-    if parallel:
-        handler.parallel_process(grabber, function, multiplier)
-    else:
-        handler.solo_process(grabber, function)
-    with open('output_status.csv', 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            ['Path', 'tolerance', 'same r-g', 'same r-b', 'same g-b', 'data r-g', 'data r-b', 'data g-b',
-             'Classification'])
-        for name, values in dict_3d.items():
-            writer.writerow([name] + values)
+    results = Results(args.results, columns())
+
+    def write(image_path, rows):
+        # streamed in as each image finishes, so a crash keeps what was done
+        if not isinstance(rows, handler.Failure):
+            for values in rows:
+                values[7] = ' '.join(values[7])
+                results.append([image_path.as_posix()] + values)
+
+    try:
+        if parallel:
+            handler.parallel_process(grabber, function, multiplier, callback=write)
+        else:
+            handler.solo_process(grabber, function, write)
+    finally:
+        results.close()
@@ -1,54 +1,118 @@
+import argparse
 import csv
+from pathlib import Path
 import numpy as np
 
-# Open CSV file for reading
+import matplotlib
+
+from packageland import channels, features
+
+COLUMNS = ['Average(R-G)/Brightness', 'Average(R-B)/Brightness', 'Average(G-B)/Brightness']
+
+parser = argparse.ArgumentParser(description="Heuristic Values, plot the normalized channel differences of images")
+parser.add_argument('--input', '-i', metavar='-I', type=str, default='output_normalized.csv',
+                    help='csv of path, Average(R-G)/Brightness, Average(R-B)/Brightness, Average(G-B)/Brightness, '
+                         'or a heuristic_features directory. default = output_normalized.csv')
+parser.add_argument('--mode', '-m', metavar='-M', type=str, default='auto',
+                    help='scatter (every point), density (hexbin 2d plots, 3d plot of a sample) or auto (density past '
+                         '--max-points), default = auto')
+parser.add_argument('--max-points', '-n', metavar='-N', type=int, default=50000,
+                    help='most points a scatter plot draws, default = 50000')
+parser.add_argument('--output', '-o', metavar='-O', type=str, default=None,
+                    help='save the plots as [output]_3d.png and [output]_2d.png instead of showing them, works without '
+                         'a display')
+args = parser.parse_args()
+
+if args.output:
+    # headless, has to be picked before pyplot is imported
+    matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 
-with open('output_normalized.csv', 'r') as f:
-    reader = csv.reader(f)
-
-    # Read header row to get column names
-    header = next(reader)
-    # Create dictionary from remaining rows
-    my_dict = {}
-    for row in reader:
-        name = row[0]
-        values = np.asarray([float(x) for x in row[1:]])
-        my_dict[name] = values
-
-# Print dictionary
-print(my_dict)
-count = 0
-for key, values in my_dict.items():
-    if np.any(abs(values) > 1):
-        count += 1
-print(count)
-
-fig = plt.figure(figsize=(16, 16))
-ax = fig.add_subplot(projection='3d')
-for coords in my_dict.values():
-    ax.scatter(abs(coords[0]), abs(coords[1]), abs(coords[2]))
-ax.set_xlabel('Average(R - G) / Brightness')
-ax.set_ylabel('Average(R - B) / Brightness')
-ax.set_zlabel('Average(G - B) / Brightness')
-ax.grid(True, which='major')
-# given that this is sort of unintelligible
-plt.title("NORMALIZED |Average(Channel_G - Channel_B)| over |Average(Channel_R - Channel_B)| over |Average(Channel_R - Channel_G)|")
-plt.show()
-fig, (ax1, ax2) = plt.subplots(nrows=1, ncols=2, figsize=(16, 8))
-for coords in my_dict.values():
-    #if np.all(abs(coords) > 0):
-    ax1.scatter(abs(coords[0]), abs(coords[1]))
-    ax2.scatter(abs(coords[0]), abs(coords[2]))
-ax1.set_xlabel('Average(R - G)/ Brightness')
-ax1.set_ylabel('Average(R - B) / Brightness')
-ax2.set_xlabel('Average(R - G) / Brightness')
-ax2.set_ylabel('Average(G - B) / Brightness')
-ax1.grid(True, which='major')
-ax2.grid(True, which='major')
-ax1.set_title("NORMALIZED |Average(Channel_R - Channel_B)| over |Average(Channel_R - Channel_G)|")
-ax2.set_title("NORMALIZED |Average(Channel_G - Channel_B)| over |Average(Channel_R - Channel_G)|")
-plt.show()
+
+def load_features(path):
+    """
+    the normalized differences from a heuristic_features matrix, in the same layout as load
+    """
+    rows, columns, matrix = features.load(path)
+    names = np.asarray(list(rows))
+    values = np.asarray(matrix[:, [columns.index('normalized ' + pair) for pair in channels.PAIR_NAMES]], np.float64)
+    # black images have no brightness to normalize by, and failed ones no row
+    keep = np.isfinite(values).all(axis=1)
+    names, values = names[keep], values[keep]
+    table = np.empty(len(names), dtype=[('Path', names.dtype)] + [(name, np.float64) for name in COLUMNS])
+    table['Path'] = names
+    for i, name in enumerate(COLUMNS):
+        table[name] = values[:, i]
+    return table, np.abs(values)
+
+
+def load(path):
+    """
+    the whole csv as one structured array, path plus a float64 field per column, parsed in C by loadtxt
+    """
+    if Path(path).is_dir():
+        return load_features(path)
+    with open(path, newline='') as f:
+        header = next(csv.reader(f))
+    names = np.loadtxt(path, dtype=str, delimiter=',', skiprows=1, usecols=0, quotechar='"', ndmin=1)
+    values = np.loadtxt(path, dtype=np.float64, delimiter=',', skiprows=1, usecols=range(1, len(header)),
+                        quotechar='"', ndmin=2)
+    table = np.empty(len(names), dtype=[(header[0], names.dtype)] + [(name, np.float64) for name in header[1:]])
+    table[header[0]] = names
+    for i, name in enumerate(header[1:]):
+        table[name] = values[:, i]
+    return table, np.abs(values)
+
+
+def finish(fig, suffix):
+    if args.output:
+        fig.savefig(args.output + suffix, dpi=100)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def plot_3d(coords, density):
+    if density and len(coords) > args.max_points:
+        # a 3d scatter can't bin, so draw an even sample instead of every point
+        coords = coords[np.random.default_rng(0).choice(len(coords), args.max_points, replace=False)]
+    fig = plt.figure(figsize=(16, 16))
+    ax = fig.add_subplot(projection='3d')
+    ax.scatter(coords[:, 0], coords[:, 1], coords[:, 2], s=2, alpha=0.5 if density else 1)
+    ax.set_xlabel('Average(R - G) / Brightness')
+    ax.set_ylabel('Average(R - B) / Brightness')
+    ax.set_zlabel('Average(G - B) / Brightness')
+    ax.grid(True, which='major')
+    # given that this is sort of unintelligible
+    plt.title("NORMALIZED |Average(Channel_G - Channel_B)| over |Average(Channel_R - Channel_B)| over |Average(Channel_R - Channel_G)|")
+    finish(fig, '_3d.png')
+
+
+def plot_2d(coords, density):
+    fig, (ax1, ax2) = plt.subplots(nrows=1, ncols=2, figsize=(16, 8))
+    for ax, y in ((ax1, coords[:, 1]), (ax2, coords[:, 2])):
+        if density:
+            fig.colorbar(ax.hexbin(coords[:, 0], y, gridsize=200, bins='log', mincnt=1), ax=ax)
+        else:
+            ax.scatter(coords[:, 0], y, s=2)
+    ax1.set_xlabel('Average(R - G)/ Brightness')
+    ax1.set_ylabel('Average(R - B) / Brightness')
+    ax2.set_xlabel('Average(R - G) / Brightness')
+    ax2.set_ylabel('Average(G - B) / Brightness')
+    ax1.grid(True, which='major')
+    ax2.grid(True, which='major')
+    ax1.set_title("NORMALIZED |Average(Channel_R - Channel_B)| over |Average(Channel_R - Channel_G)|")
+    ax2.set_title("NORMALIZED |Average(Channel_G - Channel_B)| over |Average(Channel_R - Channel_G)|")
+    finish(fig, '_2d.png')
+
+
+if __name__ == '__main__':
+    table, coords = load(args.input)
+    print(table)
+    print(np.count_nonzero(np.any(coords > 1, axis=1)))
+    density = args.mode == 'density' or (args.mode == 'auto' and len(coords) > args.max_points)
+    plot_3d(coords, density)
+    plot_2d(coords, density)
 
 # R,G,B = Red, Blue, Green
 # channel cases:
@@ -4,9 +4,12 @@ import shutil
 import numpy
 from pathlib import Path
 
-from PIL import Image, ImageChops
+from PIL import Image
 
-from packageland import handler
+from packageland import flat_index, handler
+from packageland.encoder import PROFILES, Encoder
+from packageland.links import LINK_MODES, place
+from packageland.manifest import Manifest, content_hash
 
 Image.MAX_IMAGE_PIXELS = None
 
@@ -22,6 +25,27 @@ parser.add_argument('--parallel', '-p', metavar='-P', action=argparse.BooleanOpt
                     help='multicore processing')
 parser.add_argument('--multiplier', '-m', metavar='-M', type=int, default=5,
                     help='if using multicore processing, job multiplier per core. default = 5')
+parser.add_argument('--scheduler', '-s', metavar='-S', type=str, default='stream',
+                    help='if using multicore processing, "stream" (one pool for the whole run) or "chunk" (one pool per '
+                         'chunk), default = stream')
+parser.add_argument('--largest-first', '-l', metavar='-L', action=argparse.BooleanOptionalAction,
+                    help='if using multicore processing, dispatch the largest images first')
+parser.add_argument('--memory-budget', '-b', metavar='-B', type=float, default=None,
+                    help='if using multicore processing, max MiB of decoded images in flight at once, default = no limit')
+parser.add_argument('--incremental', '-i', metavar='-I', action=argparse.BooleanOptionalAction,
+                    help='skip images this command already handled with the same --encoding and --link-mode, whose inputs '
+                         'haven\'t changed and whose outputs are still there, see [directory]_manifest.sqlite')
+parser.add_argument('--hash', metavar='-H', action=argparse.BooleanOptionalAction,
+                    help='with --incremental, also compare file contents, so touched but unchanged images are skipped')
+parser.add_argument('--encoding', '-e', metavar='-E', type=str, default='fastest', choices=list(PROFILES),
+                    help='output encoding profile, fastest, balanced, smallest or tga (uncompressed, for intermediate '
+                         'stages), default = fastest')
+parser.add_argument('--encode-threads', '-t', metavar='-T', type=int, default=0,
+                    help='threads per process that encode outputs while the image\'s next channel is prepared, '
+                         'default = 0 (encode inline)')
+parser.add_argument('--link-mode', '-k', metavar='-K', type=str, default='copy', choices=LINK_MODES,
+                    help='how flatten, unflatten and merge put unchanged files in the output, copy, hardlink, symlink or '
+                         'reflink. falls back to copy where the link can\'t be made. default = copy')
 args = parser.parse_args()
 
 if args.directory.endswith('/') or args.directory.endswith('\\'):
@@ -32,7 +56,27 @@ p = Path(folder)
 command = args.command
 parallel = args.parallel
 multiplier = args.multiplier
-unimplemented_type = []
+scheduler = args.scheduler
+largest_first = args.largest_first
+memory_budget = None if args.memory_budget is None else int(args.memory_budget * 2 ** 20)
+incremental = args.incremental
+manifest_path = Path(str(folder) + '_manifest.sqlite')
+encoder = Encoder(args.encoding, args.encode_threads)
+link_mode = args.link_mode
+index_path = Path(str(folder) + '_flat_index.json')
+# commands that write flat outputs, and the ones that read them back
+FLAT_WRITERS = ['flatten', 'split', '4split', 'gray_rgb']
+FLAT_READERS = ['unflatten', 'unflatten_rgba', 'merge', 'alpha_merge', '4merge']
+# the sibling directories each reader looks in
+SIBLINGS = {'merge': ['_RGB', '_A'], 'alpha_merge': ['_RGB', '_A'], '4merge': ['_R', '_G', '_B', '_A'],
+            'unflatten': ['_flattened'], 'unflatten_rgba': ['_RGBA']}
+# set by load_index
+flat_names = {}
+listings = {}
+# the outputs of the image being handled, see do_command
+written = []
+# set in main with --incremental
+manifest = None
 
 
 # output_suffix = args.output.lower()
@@ -40,43 +84,53 @@ unimplemented_type = []
 
 def save(image, path, suffix=None):
     path.parent.mkdir(exist_ok=True, parents=True)
-    if suffix is not None:
-        image.save(path.with_suffix(suffix))
-    # elif output_suffix is not None and output_suffix == 'tga':
-    #     # make this not stupid later
-    #     image.save(path.with_suffix('.tga'))
-    else:
-        image.save(path.with_suffix('.png'), compress_level=1)
+    encoder.save(image, path.with_suffix(suffix or encoder.suffix))
+    written.append(path.with_suffix(suffix or encoder.suffix))
+
+
+def put(src, dst):
+    """
+    place, and note the output for the manifest
+    """
+    place(src, dst, link_mode)
+    written.append(dst)
 
 
 def make_path(path, d_suffix, flat=True, f_suffix=None):
-    if f_suffix:
-        path = path.with_suffix(f_suffix)
     out_folder = Path(str(folder) + d_suffix)
     if flat:
         out_path = Path.joinpath(out_folder, flatten_path(path))
     else:
         out_path = Path.joinpath(out_folder, Path(*path.parts[1:]))
+    if f_suffix:
+        out_path = out_path.with_suffix(f_suffix)
     return out_path
 
 
 def flatten_path(path):
-    flattened_path = Path(str(path.parent).replace('\\', '') + path.name)
-    return flattened_path
+    """
+    the name from the flat index, see load_index
+    """
+    return Path(flat_names.get(path.as_posix()) or flat_index.flat_name(path))
 
 
-def unflatten_path(path):
-    unflattened_path = Path(str(path.parent).replace('😊', '\\') + path.name)
-    return unflattened_path
+def load_index(names, scanned):
+    """
+    set the flat index and the directory listings for this process, passed to each worker once when it starts
+    :param names: {path as posix: flat name}
+    :param scanned: {directory suffix: flat_index.scan of [directory][suffix]}
+    """
+    global flat_names, listings
+    flat_names = names
+    listings = scanned
 
 
-def check_path_exists(path):
-    if not path.exists():
-        if path.with_suffix('.png').exists():
-            path = path.with_suffix('.png')
-        if path.with_suffix('.tga').exists():
-            path = path.with_suffix('.tga')
-    return path
+def find_sibling(path, d_suffix):
+    """
+    flat output of `path` in [directory][d_suffix], with its .png/.tga variant looked up in the listing from startup
+    instead of on disk
+    """
+    return flat_index.resolve(listings[d_suffix], make_path(path, d_suffix))
 
 
 def do_thing_rgb_gray_fix(path):
@@ -120,10 +174,8 @@ def do_thing_gray_rgb(path):
 
 
 def do_thing_flatten_RGBA_only(path):
-    rgb_path = make_path(path, '_RGB')
-    rgb_path = check_path_exists(rgb_path)
-    alpha_path = make_path(path, '_A')
-    alpha_path = check_path_exists(alpha_path)
+    rgb_path = find_sibling(path, '_RGB')
+    alpha_path = find_sibling(path, '_A')
     try:
         image = Image.open(rgb_path)
         merged_path = make_path(path, '_output', False)
@@ -141,8 +193,7 @@ def do_thing_flatten_RGBA_only(path):
         pass
 
 def do_thing_unflatten_rgba(path):
-    flattened_path = make_path(path, '_RGBA')
-    flattened_path = check_path_exists(flattened_path)
+    flattened_path = find_sibling(path, '_RGBA')
     try:
         with Image.open(flattened_path) as image:
             merged_path = make_path(path, '_output', False)
@@ -157,76 +208,105 @@ def do_thing_flatten(path):
     """
     out_path = make_path(path, '_flattened')
     out_path.parent.mkdir(exist_ok=True, parents=True)
-    shutil.copy(path, out_path)
+    put(path, out_path)
 
 
 def do_thing_unflatten(path):
-    flattened_path = make_path(path, '_flattened')
-    flattened_path = check_path_exists(flattened_path)
+    flattened_path = find_sibling(path, '_flattened')
     try:
         out_path = make_path(path, '_unflattened', False)
         out_path.parent.mkdir(exist_ok=True, parents=True)
-        shutil.copy(flattened_path, out_path)
+        put(flattened_path, out_path)
     except FileNotFoundError:
         pass
 
 
+def get_alpha(image):
+    """
+    :return: the alpha channel, or None if there isn't one or it's pure white
+    """
+    if 'A' not in image.getbands():
+        return None
+    alpha = image.getchannel('A')
+    # check if pure white, getextrema is one pass in C and doesn't need an inverted copy
+    if alpha.getextrema()[0] == 255:
+        return None
+    return alpha
+
+
 def do_thing_split_RGB_A(path):
     """
     flatten dir, separate RGB and A, and save to PNG
+    :return: the file name if PIL can't read its format
     """
     try:
         with Image.open(path) as image:
             rgb_path = make_path(path, '_RGB')
             alpha_path = make_path(path, '_A')
-            save(image.convert('RGB'), rgb_path)
-            try:
-                with image.getchannel('A') as alpha:
-                    # check if pure white
-                    if ImageChops.invert(alpha).getbbox():
-                        save(alpha, alpha_path)
-            except ValueError:
-                pass
+            # no copy if it's RGB already
+            save(image if image.mode == 'RGB' else image.convert('RGB'), rgb_path)
+            alpha = get_alpha(image)
+            if alpha is not None:
+                save(alpha, alpha_path)
     except NotImplementedError:
-        unimplemented_type.append(path.name)
+        return path.name
 
 
 def do_thing_split_R_G_B_A(path):
     """
     flatten dir, separate R, G, B, A, and save to PNG
+    :return: the file name if PIL can't read its format
     """
     try:
         with Image.open(path) as image:
-            red_path, green_path, blue_path, alpha_path = [make_path(path, '_R'),
-                                                           make_path(path, '_G'),
-                                                           make_path(path, '_B'),
-                                                           make_path(path, '_A')]
-            save(image.getchannel('R'), red_path)
-            save(image.getchannel('G'), green_path)
-            save(image.getchannel('B'), blue_path)
-            try:
-                with image.getchannel('A') as alpha:
-                    if ImageChops.invert(alpha).getbbox():
-                        save(alpha, alpha_path)
-            except ValueError:
-                pass
+            # decoded once here, each channel is a single plane copy that is dropped as soon as it is saved
+            image.load()
+            for channel in 'RGB':
+                save(image.getchannel(channel), make_path(path, '_' + channel))
+            alpha = get_alpha(image)
+            if alpha is not None:
+                save(alpha, make_path(path, '_A'))
     except NotImplementedError:
-        unimplemented_type.append(path.name)
+        return path.name
+
+
+def is_solid(image):
+    """
+    whether every pixel is the same color, with getextrema instead of getcolors (which gives up past 256 colors). the
+    image is compared in strips of 1, 2, 4, ... rows and most textures already differ within their first rows, but the
+    first crop still loads (decodes) the whole image, so the early exit saves the comparison, not the decode.
+    """
+    first = None
+    y, rows = 0, 1
+    while y < image.height:
+        extrema = image.crop((0, y, image.width, min(y + rows, image.height))).getextrema()
+        if len(image.getbands()) == 1:
+            extrema = (extrema,)
+        if any(low != high for low, high in extrema):
+            return False
+        if first is None:
+            first = extrema
+        elif extrema != first:
+            return False
+        y, rows = y + rows, rows * 2
+    return True
 
 
 def do_thing_get_solid_colors(path):
     solid_color_path = make_path(path, '_S', False)
-    image = Image.open(path)
-    try:
-        if len(image.getcolors()) == 1:
+    with Image.open(path) as image:
+        solid = is_solid(image)
+        if solid and path.suffix.lower() != encoder.suffix:
             save(image, solid_color_path)
-            image.close()
-            path.unlink()
+            encoder.wait()
+    if solid:
+        if path.suffix.lower() == encoder.suffix:
+            # already what save would write, just move it
+            solid_color_path.parent.mkdir(exist_ok=True, parents=True)
+            shutil.move(path, solid_color_path)
+            written.append(solid_color_path)
         else:
-            image.close()
-    except TypeError:
-        # if color is greater than 256
-        image.close()
+            path.unlink()
 
 
 def do_thing_TGA_PNG(path):
@@ -236,7 +316,9 @@ def do_thing_TGA_PNG(path):
     if path.suffix == '.tga':
         image = Image.open(path)
         if not image.mode == 'RGBA':
-            image.save(path.with_suffix('.png'), compress_level=1)
+            encoder.save(image, path.with_suffix('.png'))
+            written.append(path.with_suffix('.png'))
+            encoder.wait()
             image.close()
             path.unlink()
         else:
@@ -245,10 +327,7 @@ def do_thing_TGA_PNG(path):
 
 def do_thing_merge_R_G_B_A(path):
     red_path, green_path, blue_path, alpha_path = (
-        make_path(path, '_R'), make_path(path, '_G'), make_path(path, '_B'), make_path(path, '_A'))
-    red_path, green_path, blue_path, alpha_path = (
-        check_path_exists(red_path), check_path_exists(green_path), check_path_exists(blue_path),
-        check_path_exists(alpha_path))
+        find_sibling(path, '_R'), find_sibling(path, '_G'), find_sibling(path, '_B'), find_sibling(path, '_A'))
     try:
         with Image.merge('RGB', [Image.open(red_path).convert('L'), Image.open(green_path).convert('L'),
                                  Image.open(blue_path).convert('L')]) as image:
@@ -264,10 +343,8 @@ def do_thing_merge_R_G_B_A(path):
 
 
 def do_thing_merge_RGB_A(path):
-    rgb_path = make_path(path, '_RGB')
-    rgb_path = check_path_exists(rgb_path)
-    alpha_path = make_path(path, '_A')
-    alpha_path = check_path_exists(alpha_path)
+    rgb_path = find_sibling(path, '_RGB')
+    alpha_path = find_sibling(path, '_A')
     try:
         image = Image.open(rgb_path)
         merged_path = make_path(path, '_output', False)
@@ -280,12 +357,22 @@ def do_thing_merge_RGB_A(path):
             # save(image, merged_path)
             image.close()
             merged_path.parent.mkdir(exist_ok=True, parents=True)
-            shutil.copy(rgb_path, merged_path.with_suffix(".png"))
+            # keep the suffix of what is actually there, _RGB may hold .tga from --encoding tga
+            put(rgb_path, merged_path.with_suffix(rgb_path.suffix))
             pass
     except FileNotFoundError:
         pass
 
 
+def command_inputs(path):
+    """
+    the files the command reads for `path`, for the manifest. merge style commands read the sibling directories.
+    """
+    if command.lower() not in SIBLINGS:
+        return [path]
+    return [find_sibling(path, d_suffix) for d_suffix in SIBLINGS[command.lower()]]
+
+
 def read_command(command):
     if "flatten" == command.lower():
         return do_thing_flatten
@@ -315,12 +402,62 @@ def read_command(command):
         return do_thing_flatten_RGBA_only
 
 
+def do_command(path):
+    """
+    run the command on one image, then wait for its outputs to finish encoding
+    :return: what the command returned, or with --incremental (outputs, content hash of the inputs) once it's handled
+    """
+    del written[:]
+    # hashed here in the worker, before a destructive command removes the input
+    digest = content_hash(command_inputs(path)) if incremental and args.hash else None
+    try:
+        result = read_command(command)(path)
+    finally:
+        encoder.wait()
+    if incremental and result is None:
+        return [output.as_posix() for output in written], digest
+    return result
+
+
+def record(path, result):
+    """
+    handler callback, marks the images the command handled in the manifest, with their outputs
+    """
+    if isinstance(result, tuple):
+        outputs, digest = result
+        manifest.record(path, outputs, digest)
+
+
 if __name__ == '__main__':
-    grabber = list(p.glob('**/*.*'))
-    function = read_command(command)
-    if parallel:
-        handler.parallel_process(grabber, function, multiplier)
+    if command.lower() in FLAT_READERS and index_path.exists():
+        index = flat_index.read(index_path)
+        grabber = [Path.joinpath(p, relative) for relative in index.values()]
     else:
-        handler.solo_process(grabber, function)
+        grabber = list(p.glob('**/*.*'))
+        # names from the last run stay put, only new files get new ones
+        existing = flat_index.read(index_path) if index_path.exists() else None
+        index = flat_index.build(grabber, p, existing) if command.lower() in FLAT_WRITERS + FLAT_READERS else {}
+        if command.lower() in FLAT_WRITERS:
+            flat_index.write(index, index_path)
+    initargs = ({Path.joinpath(p, relative).as_posix(): name for name, relative in index.items()},
+                {d_suffix: flat_index.scan(str(folder) + d_suffix) for d_suffix in SIBLINGS.get(command.lower(), [])})
+    load_index(*initargs)
+    function = do_command
+    callback = record if incremental else None
+    if incremental:
+        # a different encoding or link mode makes different outputs, so it's a different job
+        manifest = Manifest(manifest_path, ';'.join([command.lower(), 'encoding=' + args.encoding,
+                                                     'link_mode=' + link_mode]), args.hash)
+        grabber = [path for path in grabber if not manifest.is_done(path, command_inputs(path))]
+    try:
+        if parallel:
+            results = handler.parallel_process(grabber, function, multiplier, scheduler, largest_first, memory_budget,
+                                               callback, load_index, initargs)
+        else:
+            results = handler.solo_process(grabber, function, callback)
+    finally:
+        if incremental:
+            manifest.close()
+    unimplemented_type = [result for result in results if isinstance(result, str)]
     for item in unimplemented_type:
         print(item)
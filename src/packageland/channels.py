@@ -0,0 +1,100 @@
+import numpy as np
+
+# pixels compared per strip
+STRIP_PIXELS = 1 << 20
+# channel pairs, in the order r-g, r-b, g-b
+PAIRS = ((0, 1), (0, 2), (1, 2))
+PAIR_NAMES = ('r-g', 'r-b', 'g-b')
+# what features returns, in order
+FEATURES = ([kind + ' ' + pair for kind in ('normalized', 'mean', 'std', 'mse', 'percent') for pair in PAIR_NAMES] +
+            ['brightness'])
+
+
+def rgb(image):
+    """
+    the R, G and B planes of a PIL image as one (height, width, 3) uint8 array, from a single decode
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    return np.asarray(image)[..., :3]
+
+
+def scan(pixels, tolerance=None, histogram=False, strip_rows=None):
+    """
+    how far apart the channels are, a strip of rows at a time in int16 instead of whole int64 planes.
+    :param pixels: (height, width, 3) uint8, see rgb
+    :param tolerance: stop early once every pair is known to differ by more than this and every channel is known to
+    have data, the differences returned are then only lower bounds. None to go through the whole image.
+    :param histogram: also count how many pixels differ by each amount 0-255, per pair. needs tolerance None.
+    :param strip_rows: rows per strip, default is about STRIP_PIXELS pixels per strip
+    :return: max absolute difference of (r-g, r-b, g-b), (r, g, b) 1 if the channel isn't a single value else 0, and
+    the (3, 256) histograms of the differences or None
+    """
+    height, width = pixels.shape[:2]
+    rows = strip_rows or max(1, STRIP_PIXELS // max(width, 1))
+    max_diff = [0, 0, 0]
+    data = [0, 0, 0]
+    histograms = np.zeros((3, 256), np.int64) if histogram else None
+    if height == 0 or width == 0:
+        return max_diff, data, histograms
+    first = pixels[0, 0]
+    for y in range(0, height, rows):
+        strip = pixels[y: y + rows]
+        wide = strip.astype(np.int16)
+        for k, (a, b) in enumerate(PAIRS):
+            if tolerance is None or max_diff[k] <= tolerance:
+                diff = np.abs(wide[..., a] - wide[..., b])
+                max_diff[k] = max(max_diff[k], int(diff.max()))
+                if histogram:
+                    histograms[k] += np.bincount(diff.ravel(), minlength=256)
+        for c in range(3):
+            if not data[c]:
+                data[c] = int((strip[..., c] != first[c]).any())
+        if tolerance is not None and min(max_diff) > tolerance and all(data):
+            break
+    return max_diff, data, histograms
+
+
+def percent_within(histograms, tolerance):
+    """
+    the share of pixels whose channels differ by at most `tolerance`, per pair, from the histograms of scan
+    """
+    total = histograms.sum(axis=1)
+    if tolerance < 0 or not total.all():
+        return [0.0, 0.0, 0.0]
+    return (histograms[:, :int(tolerance) + 1].sum(axis=1) / total).tolist()
+
+
+def features(pixels, tolerance=0, strip_rows=None):
+    """
+    the channel difference features of an image in one pass over strips of rows. the mean, std and mse of each pair's
+    difference all come from its sum and sum of squares, and the brightness (rms of PIL's L conversion) from the same
+    strips.
+    :param pixels: (height, width, 3) uint8, see rgb
+    :param tolerance: pixels whose channels differ by at most this count as the same, for percent
+    :return: float64 array in the order of FEATURES, normalized is mean / brightness
+    """
+    height, width = pixels.shape[:2]
+    rows = strip_rows or max(1, STRIP_PIXELS // max(width, 1))
+    total = np.zeros(3, np.int64)
+    total2 = np.zeros(3, np.int64)
+    within = np.zeros(3, np.int64)
+    brightness2 = 0
+    for y in range(0, height, rows):
+        wide = pixels[y: y + rows].astype(np.int32)
+        for k, (a, b) in enumerate(PAIRS):
+            diff = wide[..., a] - wide[..., b]
+            total[k] += diff.sum()
+            total2[k] += np.square(diff, dtype=np.int64).sum()
+            within[k] += np.count_nonzero(np.abs(diff) <= tolerance)
+        # ITU-R 601-2 luma, with PIL's rounding
+        luma = (wide[..., 0] * 19595 + wide[..., 1] * 38470 + wide[..., 2] * 7471 + 0x8000) >> 16
+        brightness2 += int(np.square(luma, dtype=np.int64).sum())
+    count = max(height * width, 1)
+    mean = total / count
+    mse = total2 / count
+    brightness = np.sqrt(brightness2 / count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = mean / brightness
+    return np.concatenate([normalized, mean, np.sqrt(np.maximum(mse - mean ** 2, 0)), mse, within / count,
+                           [brightness]])
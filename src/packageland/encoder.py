@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import ImageFile
+
+# save options per profile and output suffix
+PROFILES = {
+    'fastest': {'.png': {'compress_level': 1}},
+    'balanced': {'.png': {'compress_level': 6}},
+    'smallest': {'.png': {'compress_level': 9, 'optimize': True}, '.tga': {'compression': 'tga_rle'}},
+    # uncompressed TGA for intermediate stages, PNGs that still get written are fast ones
+    'tga': {'.png': {'compress_level': 1}},
+}
+
+
+class Encoder:
+    """
+    saves images with the options of a profile. with threads, the saves run in a thread pool (zlib releases the GIL)
+    and wait() blocks until they are written.
+    """
+
+    def __init__(self, profile='fastest', threads=0):
+        self.options = PROFILES[profile]
+        self.suffix = '.tga' if profile == 'tga' else '.png'
+        self.threads = threads
+        self.executor = None
+        self.pending = []
+
+    def save(self, image, path):
+        options = self.options.get(path.suffix.lower(), {})
+        if not self.threads:
+            image.save(path, **options)
+            return
+        if isinstance(image, ImageFile.ImageFile):
+            # still attached to its file, the caller's with-block would close it under the thread
+            image = image.copy()
+        if self.executor is None:
+            # made on first use, so every worker process gets its own
+            self.executor = ThreadPoolExecutor(self.threads)
+        self.pending.append(self.executor.submit(image.save, path, **options))
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
@@ -0,0 +1,31 @@
+from pathlib import Path
+
+import numpy as np
+
+
+def create(path, paths, columns):
+    """
+    a feature matrix on disk, one row per image and one column per feature, memory-mapped so rows can be filled in as
+    images finish and read back later without loading the whole thing. rows are nan until filled.
+    :param path: directory, gets matrix.npy, paths.npy and columns.npy
+    :return: the writable (len(paths), len(columns)) float32 memmap
+    """
+    path = Path(path)
+    path.mkdir(exist_ok=True, parents=True)
+    np.save(path / 'paths.npy', np.asarray([Path(image_path).as_posix() for image_path in paths], str))
+    np.save(path / 'columns.npy', np.asarray(columns, str))
+    matrix = np.lib.format.open_memmap(path / 'matrix.npy', mode='w+', dtype=np.float32,
+                                       shape=(len(paths), len(columns)))
+    matrix[:] = np.nan
+    return matrix
+
+
+def load(path, mode='r'):
+    """
+    :return: {image path: row}, column names, and the matrix memory-mapped with `mode`
+    """
+    path = Path(path)
+    paths = np.load(path / 'paths.npy')
+    columns = np.load(path / 'columns.npy').tolist()
+    matrix = np.load(path / 'matrix.npy', mmap_mode=mode)
+    return {image_path: row for row, image_path in enumerate(paths.tolist())}, columns, matrix
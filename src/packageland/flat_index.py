@@ -0,0 +1,79 @@
+import json
+import os
+
+
+def flat_name(path):
+    """
+    the directories of `path` glued in front of its name, separators dropped
+    """
+    return ''.join(path.parent.parts).replace('\\', '').replace('/', '') + path.name
+
+
+def build(paths, root, existing=None):
+    """
+    map flat names to the files they came from. names are compared by stem and case-insensitively, since outputs
+    change suffix and windows doesn't care about case, and ones that collide get ~1, ~2, ... before the suffix.
+    :param paths: files under `root`
+    :param root: the directory being flattened
+    :param existing: the index from an earlier run, files still in `paths` keep the name they had there, so a new file
+    can't take over the name (and the outputs) of one an incremental run skips
+    :return: {flat name: path relative to root, posix style}
+    """
+    relatives = {path.relative_to(root).as_posix() for path in paths}
+    index = {}
+    taken = set()
+    for name, relative in (existing or {}).items():
+        if relative in relatives:
+            index[name] = relative
+            taken.add(os.path.splitext(name)[0].casefold())
+    named = set(index.values())
+    for path in sorted(paths, key=lambda x: x.as_posix()):
+        if path.relative_to(root).as_posix() in named:
+            continue
+        stem, suffix = os.path.splitext(flat_name(path))
+        name, n = stem, 0
+        while name.casefold() in taken:
+            n += 1
+            name = stem + '~' + str(n)
+        taken.add(name.casefold())
+        index[name + suffix] = path.relative_to(root).as_posix()
+    return index
+
+
+def write(index, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def read(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def scan(directory):
+    """
+    one scandir of a flat directory instead of exists() probes per file
+    :return: {stem: [file names]}
+    """
+    listing = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    listing.setdefault(os.path.splitext(entry.name)[0], []).append(entry.name)
+    except FileNotFoundError:
+        pass
+    return listing
+
+
+def resolve(listing, path):
+    """
+    the file itself if it's listed, else its .tga, else its .png, else the path as given
+    """
+    names = listing.get(path.stem, ())
+    if path.name in names:
+        return path
+    for suffix in ('.tga', '.png'):
+        if path.stem + suffix in names:
+            return path.with_suffix(suffix)
+    return path
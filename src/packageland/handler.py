@@ -1,7 +1,11 @@
 import gc
 import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 
+from PIL import Image
 from tqdm import tqdm
 # from tqdm.contrib.concurrent import process_map
 
@@ -17,17 +21,184 @@ def chunks(arr, size):
         yield arr[i: i + size]
 
 
-def parallel_process(items, function, multiplier):
+def estimate(path):
+    """
+    rough decoded size of an image in bytes, read from the header only. falls back to the file size for anything
+    PIL can't identify.
+    """
+    try:
+        with Image.open(path) as image:
+            return image.width * image.height * len(image.getbands())
+    except (OSError, ValueError):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+
+class Window:
+    """
+    limits the items in flight by count and, optionally, by their summed estimated size. one item is always let
+    through, so an image bigger than the whole budget still gets processed, just alone.
+    """
+
+    def __init__(self, size, budget=None):
+        self.size = size
+        self.budget = budget
+        self.count = 0
+        self.cost = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def has_room(self, cost):
+        if self.stopped or self.count == 0:
+            return True
+        if self.count >= self.size:
+            return False
+        return self.budget is None or self.cost + cost <= self.budget
+
+    def acquire(self, cost=0):
+        with self.condition:
+            self.condition.wait_for(lambda: self.has_room(cost))
+            self.count += 1
+            self.cost += cost
+            return not self.stopped
+
+    def release(self, cost=0):
+        with self.condition:
+            self.count -= 1
+            self.cost -= cost
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class Failure:
+    """
+    stands in for the result of an item whose function raised. exceptions don't always survive pickling, so only the
+    text of it comes back from the worker.
+    """
+
+    def __init__(self, item, error):
+        self.item = item
+        self.error = repr(error)
+        self.traceback = traceback.format_exc()
+
+    def __str__(self):
+        return str(self.item) + ": " + self.error + "\n" + self.traceback
+
+
+class Task:
+    """
+    picklable wrapper that tags each result with the index of its item, and turns exceptions into a Failure instead of
+    killing the whole run
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, task):
+        index, item = task
+        try:
+            return index, self.function(item)
+        except Exception as e:
+            return index, Failure(item, e)
+
+
+def bounded(tasks, costs, window):
+    """
+    feed tasks, but only while there is room in the window
+    :param tasks: (index, item) pairs
+    :param costs: estimated size of each item, by index
+    :param window: Window, released once per finished item
+    :return: yields each task of `tasks` that fits in `window`
+    """
+    for index, item in tasks:
+        if not window.acquire(costs[index]):
+            return
+        yield index, item
+
+
+def schedule(items, largest_first=False, memory_budget=None):
+    """
+    :return: (index, item) pairs in dispatch order, and the estimated size of each item by index
+    """
+    tasks = list(enumerate(items))
+    if not largest_first and memory_budget is None:
+        return tasks, [0] * len(items)
+    with ThreadPoolExecutor() as executor:
+        costs = list(executor.map(estimate, items))
+    if largest_first:
+        tasks.sort(key=lambda task: costs[task[0]], reverse=True)
+    return tasks, costs
+
+
+def parallel_process(items, function, multiplier, scheduler='stream', largest_first=False, memory_budget=None,
+                     callback=None, initializer=None, initargs=()):
+    """
+    :param scheduler: 'stream' keeps one pool for the whole run, 'chunk' makes a new pool per chunk
+    :param largest_first: dispatch the biggest images first, so a huge one doesn't end up alone at the end of the run
+    :param memory_budget: bytes, limit on the estimated decoded size of the images in flight. 'stream' only.
+    :param callback: called in this process as callback(item, result) as each item finishes
+    :param initializer: called as initializer(*initargs) in each worker when it starts, to ship shared state once
+    :return: what `function` returned for each item, in the order of `items`. items that raised get a Failure.
+    """
+    tasks, costs = schedule(items, largest_first, memory_budget)
+    results = [None] * len(items)
+
+    def finish(index, result):
+        results[index] = result
+        if callback is not None:
+            callback(items[index], result)
+
+    if scheduler == 'chunk':
+        chunk_process(tasks, function, multiplier, finish, initializer, initargs)
+    else:
+        stream_process(tasks, function, multiplier, finish, costs, memory_budget, initializer, initargs)
+    for result in results:
+        if isinstance(result, Failure):
+            print(result)
+    return results
+
+
+def chunk_process(tasks, function, multiplier, finish, initializer=None, initargs=()):
     core_count = os.cpu_count()
-    with tqdm(total=len(items)) as pb:
-        for chunk in chunks(items, round(core_count * multiplier)):
-            with Pool(core_count) as p:
-                p.map(function, chunk)
+    with tqdm(total=len(tasks)) as pb:
+        for chunk in chunks(tasks, round(core_count * multiplier)):
+            with Pool(core_count, initializer, initargs) as p:
+                for index, result in p.map(Task(function), chunk):
+                    finish(index, result)
                 gc.collect()
             pb.update(len(chunk))
 
 
+def stream_process(tasks, function, multiplier, finish, costs, memory_budget=None, initializer=None, initargs=()):
+    """
+    one long-lived pool, at most core_count * multiplier items in flight, progress per finished item.
+    """
+    core_count = os.cpu_count()
+    window = Window(max(core_count, round(core_count * multiplier)), memory_budget)
+    with tqdm(total=len(tasks)) as pb, Pool(core_count, initializer, initargs) as p:
+        try:
+            for index, result in p.imap_unordered(Task(function), bounded(tasks, costs, window)):
+                window.release(costs[index])
+                finish(index, result)
+                pb.update()
+        finally:
+            # the feed runs in the pool's task thread, don't leave it blocked on the window
+            window.stop()
+
+
 #    process_map() could work but there is some safety nets in here I need.
 
-def solo_process(items, function):
-    list(map(function, tqdm(items)))
+def solo_process(items, function, callback=None):
+    results = []
+    for item in tqdm(items):
+        result = function(item)
+        if callback is not None:
+            callback(item, result)
+        results.append(result)
+    return results
@@ -0,0 +1,44 @@
+import sqlite3
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from packageland.manifest import signature
+
+
+class HistogramCache:
+    """
+    sqlite store of image histograms, keyed by path and valid while the file's size and mtime are unchanged. the
+    histogram is all the histogram based filters need, so once it's here the image never has to be decoded again.
+    """
+
+    def __init__(self, path, commit_every=256):
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS histograms (source TEXT PRIMARY KEY, signature TEXT, '
+                                'histogram BLOB)')
+
+    def get(self, source):
+        """
+        :return: the histogram as a uint64 array, or None if it isn't cached or the file changed since
+        """
+        row = self.connection.execute('SELECT signature, histogram FROM histograms WHERE source = ?',
+                                      (Path(source).as_posix(),)).fetchone()
+        if row is None or row[0] != signature([source]):
+            return None
+        return np.frombuffer(zlib.decompress(row[1]), '<u8')
+
+    def put(self, source, histogram):
+        data = zlib.compress(np.asarray(histogram, '<u8').tobytes(), 1)
+        self.connection.execute('INSERT OR REPLACE INTO histograms VALUES (?, ?, ?)',
+                                (Path(source).as_posix(), signature([source]), data))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,64 @@
+import os
+import shutil
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
+LINK_MODES = ['copy', 'hardlink', 'symlink', 'reflink']
+# linux/fs.h, clone a whole file on filesystems with copy-on-write extents (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """
+    clone `src` into `dst`, which must not exist yet, so nothing is ever written through an existing file or link
+    """
+    if fcntl is None:
+        raise OSError('reflink is not supported on this platform')
+    with open(src, 'rb') as source, open(dst, 'xb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(dst)
+            raise
+
+
+def link(src, dst, mode):
+    if mode == 'hardlink':
+        os.link(src, dst)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'reflink':
+        reflink(src, dst)
+    else:
+        raise ValueError('unknown link mode: ' + str(mode))
+
+
+def place(src, dst, mode='copy'):
+    """
+    put `src` at `dst` like shutil.copy, but as a hardlink, symlink or reflink if asked. falls back to a copy when the
+    link can't be made, i.e. across filesystems or on a filesystem without support for it. the link or copy is made
+    under a unique temp name next to `dst` and renamed over it, so whatever is at `dst` (maybe a link to some source
+    from an earlier run, or from another worker writing the same name) is replaced, never written through.
+    :return: dst
+    """
+    temp = str(dst) + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        if mode != 'copy':
+            try:
+                link(src, temp, mode)
+            except OSError:
+                mode = 'copy'
+        if mode == 'copy':
+            shutil.copy(src, temp)
+        os.replace(temp, dst)
+    except BaseException:
+        if os.path.lexists(temp):
+            os.remove(temp)
+        raise
+    return dst
@@ -0,0 +1,104 @@
+import hashlib
+import os
+import sqlite3
+from pathlib import Path
+
+
+def signature(paths):
+    """
+    size and mtime of each path, '-' for the ones that don't exist
+    """
+    parts = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            parts.append(str(stat.st_size) + ':' + str(stat.st_mtime_ns))
+        except OSError:
+            parts.append('-')
+    return ';'.join(parts)
+
+
+def content_hash(paths):
+    """
+    blake2b over the contents of each path that exists
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        except OSError:
+            digest.update(b'-')
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    sqlite record of which source files a command already handled and the outputs it made for them, so re-runs skip
+    them and crashed runs resume. a source is up-to-date while the size and mtime of every file the command reads for
+    it are unchanged and every output it made is still there. with `hashed`, a source whose files were touched but not
+    changed (i.e. re-extracted) is up-to-date too.
+    """
+
+    def __init__(self, path, command, hashed=False, commit_every=64):
+        """
+        :param command: the command and whatever options change its outputs, a change in either is a different job
+        """
+        self.command = command
+        self.hashed = hashed
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.signatures = {}
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS done (command TEXT, source TEXT, signature TEXT, hash TEXT, '
+                                'outputs TEXT, PRIMARY KEY (command, source))')
+        if 'outputs' not in [row[1] for row in self.connection.execute('PRAGMA table_info(done)')]:
+            # manifests from before outputs were recorded, their rows just get redone once
+            self.connection.execute('ALTER TABLE done ADD COLUMN outputs TEXT')
+        self.done = {source: (stored_signature, stored_hash, outputs) for
+                     source, stored_signature, stored_hash, outputs in
+                     self.connection.execute('SELECT source, signature, hash, outputs FROM done WHERE command = ?',
+                                             (command,))}
+
+    def is_done(self, source, inputs):
+        """
+        :param source: the item as handed to the command
+        :param inputs: every file the command reads for `source`
+        """
+        key = Path(source).as_posix()
+        current = signature(inputs)
+        self.signatures[key] = current
+        stored = self.done.get(key)
+        if stored is None or stored[2] is None:
+            return False
+        if not all(os.path.lexists(output) for output in stored[2].split('\n') if output):
+            return False
+        if stored[0] == current:
+            return True
+        # only hashed when the signature changed, the first run gets its hashes from the workers
+        if self.hashed and stored[1] is not None and stored[1] == content_hash(inputs):
+            self.write(key, current, stored[1], stored[2])
+            return True
+        return False
+
+    def record(self, source, outputs, digest=None):
+        """
+        mark `source` as handled, with the signature its inputs had when is_done was asked about it
+        :param outputs: every file the command wrote for `source`
+        :param digest: content_hash of the inputs, with `hashed`
+        """
+        key = Path(source).as_posix()
+        self.write(key, self.signatures.pop(key), digest, '\n'.join(outputs))
+
+    def write(self, key, current, digest, outputs):
+        self.connection.execute('INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?, ?)',
+                                (self.command, key, current, digest, outputs))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,81 @@
+import csv
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+class Results:
+    """
+    append-only table that rows are streamed into as images finish. rows are buffered and written every `chunk_rows`
+    rows, as one .npz per chunk in a directory (a column per array, so loading is a few np.load calls), or appended
+    to a csv if `path` ends in .csv. a crash only loses the rows of the chunk being buffered.
+    """
+
+    def __init__(self, path, columns, chunk_rows=4096):
+        """
+        :param columns: [(name, numpy dtype)], the schema every row follows. use str for text columns.
+        """
+        self.path = Path(path)
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.rows = []
+        self.chunk = 0
+        self.is_csv = self.path.suffix.lower() == '.csv'
+        if self.is_csv:
+            self.file = open(self.path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow([name for name, _ in columns])
+        else:
+            self.path.mkdir(exist_ok=True, parents=True)
+            # a new run, not a continuation of whatever was there
+            for old in self.path.glob('*.npz'):
+                old.unlink()
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        if self.is_csv:
+            self.writer.writerows(rows)
+            self.file.flush()
+            return
+        arrays = {name: np.asarray([row[i] for row in rows], dtype) for i, (name, dtype) in enumerate(self.columns)}
+        chunk_path = self.path / (str(self.chunk).zfill(6) + '.npz')
+        temp_path = chunk_path.with_suffix('.tmp')
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        # a chunk is either all there or not there at all
+        os.replace(temp_path, chunk_path)
+        self.chunk += 1
+
+    def close(self):
+        self.flush()
+        if self.is_csv:
+            self.file.close()
+
+
+def load(path):
+    """
+    read a table written by Results
+    :return: {column name: array}, in the order the rows were written
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.csv':
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            names = next(reader)
+            values = list(zip(*reader)) or [()] * len(names)
+        return {name: np.asarray(column) for name, column in zip(names, values)}
+    chunks = []
+    for chunk_path in sorted(path.glob('*.npz')):
+        with np.load(chunk_path) as chunk:
+            chunks.append({name: chunk[name] for name in chunk.files})
+    if not chunks:
+        return {}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
@@ -0,0 +1,52 @@
+import numpy as np
+
+# pixels packed per strip, 4M pixels is 16 MiB of codes
+STRIP_PIXELS = 1 << 22
+
+
+def pack(strip, codes, plane):
+    """
+    r | g << 8 | b << 16 into `codes`, without any full size int64 temporaries
+    :param strip: (rows, width, 3) uint8
+    :param codes: (rows, width) uint32, output
+    :param plane: (rows, width) uint32, scratch
+    """
+    np.copyto(codes, strip[..., 2])
+    codes <<= 8
+    np.copyto(plane, strip[..., 1])
+    codes |= plane
+    codes <<= 8
+    np.copyto(plane, strip[..., 0])
+    codes |= plane
+    return codes
+
+
+def count(image, threshold=None, strip_rows=None):
+    """
+    number of distinct RGB colors in a PIL image. every 24 bit color gets a slot in a 16M entry table, so it's one
+    linear pass over the pixels instead of a sort, and the pixels are packed a strip of rows at a time so memory stays
+    flat no matter the size of the image.
+    :param threshold: stop as soon as more than this many colors were seen, the count returned is then only known to be
+    past the threshold, not exact
+    :param strip_rows: rows per strip, default is about STRIP_PIXELS pixels per strip
+    :return: the number of colors
+    """
+    if image.mode in ('L', '1'):
+        # gray converts to r = g = b, so the histogram already has the answer
+        return int(np.count_nonzero(image.histogram()))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    pixels = np.asarray(image)
+    height, width = pixels.shape[:2]
+    rows = strip_rows or max(1, STRIP_PIXELS // max(width, 1))
+    seen = np.zeros(1 << 24, bool)
+    codes = np.empty((min(rows, height), width), np.uint32)
+    plane = np.empty_like(codes)
+    for y in range(0, height, rows):
+        strip = pixels[y: y + rows]
+        seen[pack(strip, codes[:len(strip)], plane[:len(strip)])] = True
+        if threshold is not None:
+            colors = np.count_nonzero(seen)
+            if colors > threshold:
+                return int(colors)
+    return int(np.count_nonzero(seen))
@@ -1,23 +1,18 @@
 import shutil
 from pathlib import Path
-import numpy as np
 from PIL import Image
-from packageland import handler
+from packageland import handler, unique_colors
 
 
-def get_unique_colors(path):
-    # https://stackoverflow.com/questions/59669715/fastest-way-to-find-the-rgb-pixel-color-count-of-image/59671950#59671950
-    with Image.open(path).convert('RGB') as img:
-        na = np.array(img)
-        f = np.dot(na.astype(np.uint32), [1, 256, 65536])
-        nColours = len(np.unique(f))
-        return nColours
+def get_unique_colors(path, threshold=None):
+    with Image.open(path) as img:
+        return unique_colors.count(img, threshold)
 
 
 def unique_color_threshold(path):
     # value = 2e6 for jank, 200-ish for not ffxiv color-maps
     value = 2e6
-    if get_unique_colors(path) > value:
+    if get_unique_colors(path, value) > value:
         shutil.copy(path, ("./threshold_matched/" + path.name))
 
 